@@ -0,0 +1,343 @@
+from pathlib import Path
+import asyncio
+import contextlib
+import json
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+import aiohttp.test_utils
+import click
+
+from boxhatter import common
+import boxhatter.backend
+import boxhatter.ui
+
+
+default_db_dir: Path = Path('build/bench')
+
+repos_count: int = 20
+
+insert_batch_size: int = 1000
+
+log_line: str = ('[{i:08}] step {step} of job {job}: '
+                 'compiling module_{module}.c ... ok\n')
+
+
+@click.command()
+@click.option('--size', 'sizes', multiple=True, type=int,
+              default=[10_000, 100_000],
+              help="number of generated commits (can be repeated, "
+                   "default 10000 and 100000)")
+@click.option('--log-size', default=16 * 1024, type=int,
+              help="average output size in bytes (default 16384)")
+@click.option('--iterations', default=50, type=int,
+              help="number of measured iterations (default 50)")
+@click.option('--db-dir', default=default_db_dir, metavar='PATH', type=Path,
+              help="directory containing generated databases "
+                   "(default build/bench)")
+@click.option('--output', metavar='PATH', type=Path, default=None,
+              help="JSON lines result path (default stdout)")
+def main(sizes: typing.List[int],
+         log_size: int,
+         iterations: int,
+         db_dir: Path,
+         output: typing.Optional[Path]):
+    with contextlib.ExitStack() as stack:
+        output_file = (stack.enter_context(output.open('w'))
+                       if output else sys.stdout)
+
+        for size in sizes:
+            db_path = db_dir / f'{size}_{log_size}.db'
+            for result in asyncio.run(async_main(db_path, size, log_size,
+                                                 iterations)):
+                output_file.write(json.dumps(result) + '\n')
+                output_file.flush()
+
+
+async def async_main(db_path: Path,
+                     size: int,
+                     log_size: int,
+                     iterations: int
+                     ) -> typing.List[dict]:
+    if not db_path.exists():
+        await generate(db_path, size, log_size)
+
+    with tempfile.TemporaryDirectory(dir=db_path.parent) as tmp_dir:
+        tmp_path = Path(tmp_dir) / db_path.name
+        for src, dst in zip(_get_db_paths(db_path), _get_db_paths(tmp_path)):
+            if src.exists():
+                shutil.copyfile(src, dst)
+
+        backend = await boxhatter.backend.create(tmp_path)
+
+        try:
+            results = [
+                *(await bench_backend(backend, iterations)),
+                *(await bench_ui(backend, iterations))]
+
+        finally:
+            await backend.async_close()
+
+    return [{'size': size,
+             'log_size': log_size,
+             **result}
+            for result in results]
+
+
+async def generate(db_path: Path,
+                   size: int,
+                   log_size: int):
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = db_path.with_suffix('.tmp')
+    for path in _get_db_paths(tmp_path):
+        path.unlink(missing_ok=True)
+
+    backend = await boxhatter.backend.create(tmp_path)
+
+    try:
+        rng = random.Random(size)
+        change = int(time.time()) - size * 60
+
+        for i in range(0, size, insert_batch_size):
+            commits = []
+            for j in range(i, min(i + insert_batch_size, size)):
+                commits.append(common.Commit(
+                    repo=f'repo{rng.randrange(repos_count)}',
+                    hash=f'{rng.getrandbits(160):040x}',
+                    change=change + j * 60,
+                    status=(common.Status.FAILURE if rng.random() < 0.1
+                            else common.Status.SUCCESS),
+                    output=_generate_log(rng, log_size)))
+            await backend.update_commits(commits)
+
+    finally:
+        await backend.async_close()
+
+    for src, dst in zip(_get_db_paths(tmp_path), _get_db_paths(db_path)):
+        if src.exists():
+            src.rename(dst)
+
+
+async def bench_backend(backend: boxhatter.backend.Backend,
+                        iterations: int
+                        ) -> typing.List[dict]:
+    commits = await backend.get_commits(repo=None,
+                                        statuses=None,
+                                        order=common.Order.DESC,
+                                        limit=None,
+                                        cursor=None)
+    rng = random.Random(0)
+    results = []
+
+    def random_cursor():
+        commit = rng.choice(commits)
+        return common.Cursor(change=commit.change,
+                             repo=commit.repo,
+                             hash=commit.hash)
+
+    def random_repo():
+        return f'repo{rng.randrange(repos_count)}'
+
+    queries = {
+        'get_commits_first_page': lambda: dict(
+            repo=None, statuses=None, order=common.Order.DESC, limit=21,
+            cursor=None),
+        'get_commits_deep_page': lambda: dict(
+            repo=None, statuses=None, order=common.Order.DESC, limit=21,
+            cursor=random_cursor()),
+        'get_commits_previous_page': lambda: dict(
+            repo=None, statuses=None, order=common.Order.ASC, limit=21,
+            cursor=random_cursor()),
+        'get_commits_repo_first_page': lambda: dict(
+            repo=random_repo(), statuses=None, order=common.Order.DESC,
+            limit=21, cursor=None),
+        'get_commits_repo_deep_page': lambda: dict(
+            repo=random_repo(), statuses=None, order=common.Order.DESC,
+            limit=21, cursor=random_cursor()),
+        'get_commits_active': lambda: dict(
+            repo=None, statuses={common.Status.PENDING,
+                                 common.Status.RUNNING},
+            order=common.Order.ASC, limit=None, cursor=None)}
+
+    for name, get_args in queries.items():
+        results.append(await _measure(
+            name, iterations,
+            lambda: backend.get_commits(**get_args())))
+
+    results.append(await _measure(
+        'get_commit', iterations,
+        lambda: backend.get_commit(*_get_key(rng.choice(commits)))))
+
+    results.append(await _measure(
+        'get_commit_metadata', iterations,
+        lambda: backend.get_commit(*_get_key(rng.choice(commits)), False)))
+
+    results.append(await _measure(
+        'get_status_counts', iterations,
+        lambda: backend.get_status_counts()))
+
+    results.append(await _measure(
+        'get_unknown_hashes', iterations,
+        lambda: backend.get_unknown_hashes(
+            random_repo(),
+            [f'{rng.getrandbits(160):040x}' for _ in range(100)])))
+
+    update_commits = [
+        common.Commit(repo=commit.repo,
+                      hash=commit.hash,
+                      change=commit.change,
+                      status=commit.status,
+                      output=None)
+        for commit in rng.sample(commits, min(iterations, len(commits)))]
+    start = time.perf_counter()
+    for commit in update_commits:
+        await backend.update_commit(commit)
+    duration = time.perf_counter() - start
+    results.append({'name': 'update_commit',
+                    'iterations': len(update_commits),
+                    'ops_per_s': len(update_commits) / duration})
+
+    info = backend.cache_info
+    results.append({'name': 'cache_info',
+                    'hits': info.hits,
+                    'misses': info.misses,
+                    'cache_size': info.size})
+
+    return results
+
+
+async def bench_ui(backend: boxhatter.backend.Backend,
+                   iterations: int
+                   ) -> typing.List[dict]:
+    commits = await backend.get_commits(repo=None,
+                                        statuses=None,
+                                        order=common.Order.DESC,
+                                        limit=1000,
+                                        cursor=None)
+    rng = random.Random(0)
+    results = []
+
+    app = boxhatter.ui.create_app(_Server(backend))
+    client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+    await client.start_server()
+
+    try:
+
+        async def get(path):
+            async with client.get(path) as res:
+                res.raise_for_status()
+                await res.read()
+
+        def commit_path():
+            commit = rng.choice(commits)
+            return f'/repo/{commit.repo}/commit/{commit.hash}'
+
+        paths = {
+            'ui_root': lambda: '/',
+            'ui_repo': lambda: f'/repo/repo{rng.randrange(repos_count)}',
+            'ui_commit': commit_path,
+            'ui_output': lambda: f'{commit_path()}/output',
+            'ui_feed': lambda: '/feed'}
+
+        for name, get_path in paths.items():
+            results.append(await _measure(
+                name, iterations, lambda: get(get_path())))
+
+    finally:
+        await client.close()
+
+    return results
+
+
+class _Server:
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    @property
+    def server_uuid(self):
+        return self._backend.server_uuid
+
+    @property
+    def repos(self):
+        return {f'repo{i}' for i in range(repos_count)}
+
+    async def get_commits(self, repo, order, limit, cursor):
+        return await self._backend.get_commits(repo=repo,
+                                               statuses=None,
+                                               order=order,
+                                               limit=limit,
+                                               cursor=cursor)
+
+    async def get_status_counts(self):
+        return await self._backend.get_status_counts()
+
+    async def get_commit(self, repo, commit_hash, with_output=True):
+        return await self._backend.get_commit(repo, commit_hash, with_output)
+
+    def get_output(self, repo, commit_hash, follow=False):
+        return self._backend.get_output(repo, commit_hash, follow)
+
+    def get_queue(self):
+        return []
+
+    def get_sync_states(self):
+        return {}
+
+    def get_cache_usage(self, repo):
+        return common.CacheUsage(size=None,
+                                 last_use=None)
+
+
+async def _measure(name, iterations, fn):
+    durations = []
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+    return {'name': name,
+            'iterations': iterations,
+            'min_ms': durations[0],
+            'mean_ms': statistics.mean(durations),
+            'p50_ms': durations[len(durations) // 2],
+            'p95_ms': durations[int(len(durations) * 0.95)],
+            'max_ms': durations[-1]}
+
+
+def _generate_log(rng, log_size):
+    size = int(rng.lognormvariate(0, 0.5) * log_size)
+    lines = []
+    length = 0
+    step = rng.randrange(1000)
+
+    while length < size:
+        line = log_line.format(i=len(lines),
+                               step=step,
+                               job=rng.randrange(4),
+                               module=rng.randrange(100))
+        lines.append(line)
+        length += len(line)
+
+    return ''.join(lines)
+
+
+def _get_key(commit):
+    return commit.repo, commit.hash
+
+
+def _get_db_paths(db_path):
+    return [db_path, *(db_path.with_name(db_path.name + suffix)
+                       for suffix in ('-wal', '-shm'))]
+
+
+if __name__ == '__main__':
+    sys.argv[0] = 'bench'
+    main()
@@ -1,4 +1,5 @@
 from pathlib import Path
+import sys
 
 from hat import json
 from hat.doit import common
@@ -9,6 +10,7 @@ from hat.doit.py import (build_wheel,
 __all__ = ['task_clean_all',
            'task_wheel',
            'task_check',
+           'task_bench',
            'task_json_schema_repo',
            'task_scss']
 
@@ -16,6 +18,7 @@ __all__ = ['task_clean_all',
 build_dir = Path('build')
 src_py_dir = Path('src_py')
 src_scss_dir = Path('src_scss')
+bench_dir = Path('bench')
 schemas_json_dir = Path('schemas_json')
 
 ui_dir = src_py_dir / 'boxhatter/ui'
@@ -23,6 +26,7 @@ ui_dir = src_py_dir / 'boxhatter/ui'
 json_schema_repo_path = src_py_dir / 'boxhatter/json_schema_repo.json'
 main_scss_path = src_scss_dir / 'main.scss'
 main_css_path = ui_dir / 'main.css'
+bench_results_path = build_dir / 'bench/results.jsonl'
 
 
 def task_clean_all():
@@ -53,7 +57,16 @@ def task_wheel():
 
 def task_check():
     """Check"""
-    return {'actions': [(run_flake8, [src_py_dir])]}
+    return {'actions': [(run_flake8, [src_py_dir]),
+                        (run_flake8, [bench_dir])]}
+
+
+def task_bench():
+    """Run benchmarks"""
+    return {'actions': [f'{sys.executable} {bench_dir / "main.py"} '
+                        f'--output {bench_results_path}'],
+            'task_dep': ['json_schema_repo',
+                         'scss']}
 
 
 def task_json_schema_repo():
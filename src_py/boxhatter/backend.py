@@ -1,18 +1,55 @@
 from pathlib import Path
+import asyncio
+import bisect
+import codecs
+import collections
+import contextlib
 import sqlite3
 import typing
 import uuid
+import zlib
 
 from hat import aio
 
 from boxhatter import common
 
 
-async def create(db_path: Path
+busy_timeout: float = 30
+
+output_chunk_size: int = 64 * 1024
+
+_max_query_params = 500
+
+_output_read_limit = 16
+
+_vacuum_pages = 1000
+
+_auto_vacuum_incremental = 2
+
+_active_statuses = {common.Status.PENDING, common.Status.RUNNING}
+
+
+StatusCounts = typing.Dict[str, typing.Dict[common.Status, int]]
+
+Refs = typing.Dict[str, typing.Dict[str, str]]
+
+
+class CacheInfo(typing.NamedTuple):
+    hits: int
+    misses: int
+    size: int
+
+
+async def create(db_path: Path,
+                 readers_count: int = 4,
+                 cache_size: int = 500
                  ) -> 'Backend':
     backend = Backend()
     backend._async_group = aio.Group()
     backend._executor = aio.create_executor(1)
+    backend._readers = aio.Queue()
+    backend._cache = _Cache(cache_size)
+    backend._output_waiters = collections.defaultdict(set)
 
     backend._db = await backend._executor(_ext_create, db_path)
     backend.async_group.spawn(aio.call_on_cancel, backend._executor,
@@ -22,6 +59,21 @@ async def create(db_path: Path
         backend._server_uuid = await backend._executor(_ext_get_server_uuid,
                                                        backend._db)
 
+        for _ in range(readers_count):
+            executor = aio.create_executor(1)
+            db = await executor(_ext_connect, db_path, True)
+            backend.async_group.spawn(aio.call_on_cancel, executor,
+                                      _ext_close, db)
+            backend._readers.put_nowait(_Reader(executor=executor, db=db))
+
+        recent_commits = await backend._read(
+            _ext_get_commits, None, None, common.Order.DESC, cache_size + 1,
+            None)
+        active_commits = await backend._read(
+            _ext_get_commits, None, _active_statuses, common.Order.ASC, None,
+            None)
+        backend._cache.init(recent_commits, active_commits)
+
     except BaseException:
         await aio.uncancellable(backend.async_close())
         raise
@@ -39,58 +91,437 @@ class Backend(aio.Resource):
     def server_uuid(self) -> uuid.UUID:
         return self._server_uuid
 
+    @property
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(hits=self._cache.hits,
+                         misses=self._cache.misses,
+                         size=len(self._cache))
+
     async def get_commits(self,
                           repo: typing.Optional[str],
                           statuses: typing.Optional[typing.Set[common.Status]],
                           order: common.Order,
                           limit: typing.Optional[int],
-                          offset: typing.Optional[int]
+                          cursor: typing.Optional[common.Cursor]
                           ) -> typing.List[common.Commit]:
-        return await self.async_group.spawn(
-            self._executor, _ext_get_commits, self._db, repo, statuses, order,
-            limit, offset)
+        commits = self._cache.get_commits(repo, statuses, order, limit,
+                                          cursor)
+        if commits is not None:
+            return commits
+
+        return await self._read(_ext_get_commits, repo, statuses, order,
+                                limit, cursor)
 
     async def get_commit(self,
                          repo: str,
-                         commit_hash: str
+                         commit_hash: str,
+                         with_output: bool = True
                          ) -> typing.Optional[common.Commit]:
+        if not with_output:
+            commit = self._cache.get_commit(repo, commit_hash)
+            if commit:
+                return commit
+
+        return await self._read(_ext_get_commit, repo, commit_hash,
+                                with_output)
+
+    async def get_output(self,
+                         repo: str,
+                         commit_hash: str,
+                         follow: bool = False
+                         ) -> typing.AsyncIterable[str]:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        event = asyncio.Event()
+        waiters = self._output_waiters[repo, commit_hash]
+        start = 0
+        offset = 0
+
+        if follow:
+            waiters.add(event)
+
+        try:
+            while True:
+                event.clear()
+                chunks = await self._read(_ext_get_output_chunks, repo,
+                                          commit_hash, start,
+                                          _output_read_limit)
+
+                for chunk, data in chunks:
+                    if chunk == start:
+                        data = data[offset:]
+
+                    text = decoder.decode(data)
+                    if text:
+                        yield text
+
+                if chunks:
+                    chunk, data = chunks[-1]
+                    if len(data) < output_chunk_size:
+                        start = chunk
+                        offset = len(data)
+
+                    else:
+                        start = chunk + 1
+                        offset = 0
+
+                if len(chunks) >= _output_read_limit:
+                    continue
+
+                if not follow or not self._cache.is_active(repo,
+                                                           commit_hash):
+                    break
+
+                await event.wait()
+
+        finally:
+            waiters.discard(event)
+            if not waiters:
+                self._output_waiters.pop((repo, commit_hash), None)
+
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    async def get_status_counts(self) -> StatusCounts:
+        return await self._read(_ext_get_status_counts)
+
+    async def get_unknown_hashes(self,
+                                 repo: str,
+                                 commit_hashes: typing.Iterable[str]
+                                 ) -> typing.List[str]:
+        commit_hashes = self._cache.get_unknown_hashes(repo, commit_hashes)
+        if not commit_hashes:
+            return commit_hashes
+
+        return await self._read(_ext_get_unknown_hashes, repo, commit_hashes)
+
+    async def get_refs(self) -> Refs:
+        return await self._read(_ext_get_refs)
+
+    async def append_output(self,
+                            repo: str,
+                            commit_hash: str,
+                            data: bytes,
+                            min_chunk: int = 0):
+        await self.async_group.spawn(aio.uncancellable,
+                                     self._append_output(repo, commit_hash,
+                                                         data, min_chunk))
+
+    async def set_output_chunk(self,
+                               repo: str,
+                               commit_hash: str,
+                               chunk: int,
+                               data: bytes):
+        await self.async_group.spawn(aio.uncancellable,
+                                     self._set_output_chunk(repo, commit_hash,
+                                                            chunk, data))
+
+    async def prune_output(self,
+                           repo: str,
+                           commit_hash: str,
+                           start: int,
+                           size: int
+                           ) -> int:
         return await self.async_group.spawn(
-            self._executor, _ext_get_commit, self._db, repo, commit_hash)
+            aio.uncancellable,
+            self._executor(_ext_prune_output, self._db, repo, commit_hash,
+                           start, size))
 
     async def update_commit(self, commit: common.Commit):
-        await self._async_group.spawn(
-            self._executor, _ext_update_commit, self._db, commit)
+        await self.update_commits([commit])
+
+    async def update_commits(self, commits: typing.Iterable[common.Commit]):
+        await self.async_group.spawn(aio.uncancellable,
+                                     self._update_commits(list(commits)))
 
     async def remove_commit(self, commit: common.Commit):
+        await self.async_group.spawn(aio.uncancellable,
+                                     self._remove_commit(commit))
+
+    async def update_refs(self,
+                          repo: str,
+                          refs: typing.Dict[str, str],
+                          removed_refs: typing.Iterable[str]):
         await self.async_group.spawn(
-            self._executor, _ext_remove_commit, self._db, commit)
+            aio.uncancellable,
+            self._executor(_ext_update_refs, self._db, repo, refs,
+                           list(removed_refs)))
+
+    async def prune_commits(self,
+                            repo: str,
+                            max_commits: typing.Optional[int],
+                            min_change: typing.Optional[int],
+                            limit: int
+                            ) -> typing.List[common.Commit]:
+        return await self.async_group.spawn(
+            aio.uncancellable,
+            self._prune_commits(repo, max_commits, min_change, limit))
+
+    async def _update_commits(self, commits):
+        await self._executor(_ext_update_commits, self._db, commits)
+        self._cache.update(commits)
+
+        for commit in commits:
+            self._notify_output(commit.repo, commit.hash)
+
+    async def _append_output(self, repo, commit_hash, data, min_chunk):
+        await self._executor(_ext_append_output, self._db, repo, commit_hash,
+                             data, min_chunk)
+        self._notify_output(repo, commit_hash)
+
+    async def _set_output_chunk(self, repo, commit_hash, chunk, data):
+        await self._executor(_ext_set_output_chunk, self._db, repo,
+                             commit_hash, chunk, data)
+        self._notify_output(repo, commit_hash)
+
+    def _notify_output(self, repo, commit_hash):
+        for event in self._output_waiters.get((repo, commit_hash), []):
+            event.set()
+
+    async def _remove_commit(self, commit):
+        await self._executor(_ext_remove_commit, self._db, commit)
+        self._cache.remove(commit.repo, commit.hash)
+
+    async def _prune_commits(self, repo, max_commits, min_change, limit):
+        commits = await self._executor(_ext_prune_commits, self._db, repo,
+                                       max_commits, min_change, limit)
+        for commit in commits:
+            self._cache.remove(commit.repo, commit.hash)
+        return commits
+
+    async def _read(self, fn, *args):
+        reader = await self._readers.get()
+
+        try:
+            return await self.async_group.spawn(reader.executor, fn,
+                                                reader.db, *args)
+
+        finally:
+            self._readers.put_nowait(reader)
+
+
+class _Reader(typing.NamedTuple):
+    executor: aio.Executor
+    db: sqlite3.Connection
+
+
+class _Cache:
+
+    def __init__(self, size):
+        self._size = size
+        self._commits = {}
+        self._keys = []
+        self._repo_keys = collections.defaultdict(list)
+        self._floor = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._commits)
+
+    def init(self, recent_commits, active_commits):
+        self._commits = {}
+        self._keys = []
+        self._repo_keys = collections.defaultdict(list)
+
+        if len(recent_commits) > self._size:
+            self._floor = _get_cursor(recent_commits[self._size])
+            recent_commits = recent_commits[:self._size]
+
+        else:
+            self._floor = None
+
+        self.update(recent_commits)
+        self.update(active_commits)
+
+    def get_commits(self, repo, statuses, order, limit, cursor):
+        if statuses is not None:
+            self.misses += 1
+            return
+
+        keys = self._repo_keys.get(repo, []) if repo else self._keys
+
+        if order == common.Order.DESC:
+            end = bisect.bisect_left(keys, cursor) if cursor else len(keys)
+            start = max(end - limit, 0) if limit is not None else 0
+            complete = (self._floor is None or
+                        (limit is not None and end - start == limit))
+            keys = reversed(keys[start:end])
+
+        else:
+            start = bisect.bisect_right(keys, cursor) if cursor else 0
+            end = start + limit if limit is not None else len(keys)
+            complete = (self._floor is None or
+                        (cursor is not None and cursor >= self._floor))
+            keys = keys[start:end]
+
+        if not complete:
+            self.misses += 1
+            return
+
+        self.hits += 1
+        return [self._commits[key.repo, key.hash] for key in keys]
+
+    def get_commit(self, repo, commit_hash):
+        commit = self._commits.get((repo, commit_hash))
+
+        if commit:
+            self.hits += 1
+
+        else:
+            self.misses += 1
+
+        return commit
+
+    def is_active(self, repo, commit_hash):
+        commit = self._commits.get((repo, commit_hash))
+        return bool(commit and commit.status in _active_statuses)
+
+    def get_unknown_hashes(self, repo, commit_hashes):
+        commit_hashes = [i for i in dict.fromkeys(commit_hashes)
+                         if (repo, i) not in self._commits]
+
+        if commit_hashes:
+            self.misses += 1
+
+        else:
+            self.hits += 1
+
+        return commit_hashes
+
+    def update(self, commits):
+        for commit in commits:
+            self.remove(commit.repo, commit.hash)
+
+            key = _get_cursor(commit)
+            if self._floor is None or key > self._floor:
+                self._commits[commit.repo, commit.hash] = commit._replace(
+                    output=None)
+                bisect.insort(self._keys, key)
+                bisect.insort(self._repo_keys[commit.repo], key)
+
+            elif commit.status in _active_statuses:
+                self._commits[commit.repo, commit.hash] = commit._replace(
+                    output=None)
+
+        while len(self._keys) > self._size:
+            key = self._keys.pop(0)
+            self._repo_keys[key.repo].remove(key)
+            self._floor = key
+
+            commit = self._commits[key.repo, key.hash]
+            if commit.status not in _active_statuses:
+                del self._commits[key.repo, key.hash]
+
+    def remove(self, repo, commit_hash):
+        commit = self._commits.pop((repo, commit_hash), None)
+        if not commit:
+            return
+
+        key = _get_cursor(commit)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+            self._repo_keys[repo].remove(key)
 
 
 def _ext_create(db_path):
     db_path.parent.mkdir(exist_ok=True)
-    db = sqlite3.connect(f'file:{db_path}?nolock=1',
-                         uri=True,
-                         isolation_level=None,
-                         detect_types=sqlite3.PARSE_DECLTYPES)
+    db = _ext_connect(db_path, False)
 
     try:
+        auto_vacuum = db.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != _auto_vacuum_incremental:
+            db.executescript(r"""
+                PRAGMA auto_vacuum = INCREMENTAL;
+                VACUUM""")
+
         db.executescript(r"""
-            PRAGMA journal_mode = OFF;
+            PRAGMA journal_mode = WAL;
             CREATE TABLE IF NOT EXISTS server_uuid (
                 uuid TEXT
-            );
+            )""")
+
+        if 'output' in _ext_get_columns(db, 'commits'):
+            db.execute("ALTER TABLE commits RENAME TO commits_legacy")
+
+        status_counts_exist = bool(_ext_get_columns(db, 'status_counts'))
+
+        db.executescript(r"""
             CREATE TABLE IF NOT EXISTS commits (
                 repo TEXT,
                 hash TEXT,
                 change INTEGER,
                 status INTEGER,
-                output TEXT,
                 PRIMARY KEY (repo, hash) ON CONFLICT REPLACE
             );
-            CREATE INDEX IF NOT EXISTS commits_change_index ON commits (
-                change
+            CREATE TABLE IF NOT EXISTS output_chunks (
+                repo TEXT,
+                hash TEXT,
+                chunk INTEGER,
+                data BLOB,
+                PRIMARY KEY (repo, hash, chunk) ON CONFLICT REPLACE
+            );
+            CREATE TABLE IF NOT EXISTS status_counts (
+                repo TEXT,
+                status INTEGER,
+                count INTEGER,
+                PRIMARY KEY (repo, status)
+            );
+            CREATE TABLE IF NOT EXISTS refs (
+                repo TEXT,
+                ref TEXT,
+                hash TEXT,
+                PRIMARY KEY (repo, ref) ON CONFLICT REPLACE
+            );
+            DROP INDEX IF EXISTS commits_change_index;
+            CREATE INDEX IF NOT EXISTS commits_order_index ON commits (
+                change, repo, hash, status
+            );
+            CREATE INDEX IF NOT EXISTS commits_repo_index ON commits (
+                repo, change, hash, status
+            );
+            CREATE INDEX IF NOT EXISTS commits_status_index ON commits (
+                status, change, repo, hash
             )""")
 
+        if _ext_get_columns(db, 'commits_legacy'):
+            with _ext_transaction(db):
+                db.execute("INSERT OR REPLACE INTO commits "
+                           "SELECT repo, hash, change, status "
+                           "FROM commits_legacy")
+                _ext_migrate_outputs(db)
+                db.execute("DROP TABLE commits_legacy")
+
+        if not status_counts_exist:
+            db.execute("INSERT INTO status_counts "
+                       "SELECT repo, status, count(*) FROM commits "
+                       "GROUP BY repo, status")
+
+    except Exception:
+        db.close()
+        raise
+
+    return db
+
+
+def _ext_migrate_outputs(db):
+    cur = db.execute("SELECT repo, hash, output FROM commits_legacy")
+    for repo, commit_hash, output in cur:
+        _ext_set_output(db, repo, commit_hash, output or '')
+
+
+def _ext_connect(db_path, query_only):
+    db = sqlite3.connect(str(db_path),
+                         timeout=busy_timeout,
+                         isolation_level=None,
+                         detect_types=sqlite3.PARSE_DECLTYPES)
+
+    try:
+        db.executescript(f"""
+            PRAGMA synchronous = NORMAL;
+            PRAGMA query_only = {'ON' if query_only else 'OFF'}""")
+
     except Exception:
         db.close()
         raise
@@ -114,9 +545,9 @@ def _ext_get_server_uuid(db):
     return server_uuid
 
 
-def _ext_get_commits(db, repo, statuses, order, limit, offset):
+def _ext_get_commits(db, repo, statuses, order, limit, cursor):
     args = {}
-    cmd = "SELECT * FROM commits"
+    cmd = "SELECT repo, hash, change, status FROM commits"
     where = []
     if repo:
         where.append("repo = :repo")
@@ -124,49 +555,332 @@ def _ext_get_commits(db, repo, statuses, order, limit, offset):
     if statuses:
         status_values = (str(status.value) for status in statuses)
         where.append(f"status IN ({', '.join(status_values)})")
+    if cursor:
+        op = '<' if order == common.Order.DESC else '>'
+        where.append(f"(change, repo, hash) {op} "
+                     f"(:cursor_change, :cursor_repo, :cursor_hash)")
+        args['cursor_change'] = cursor.change
+        args['cursor_repo'] = cursor.repo
+        args['cursor_hash'] = cursor.hash
     if where:
         cmd += f" WHERE {' AND '.join(where)}"
-    cmd += f" ORDER BY change {order.value}"
+    cmd += (f" ORDER BY change {order.value}, repo {order.value}, "
+            f"hash {order.value}")
     if limit is not None:
         cmd += " LIMIT :limit"
         args['limit'] = limit
-        if offset:
-            cmd += " OFFSET :offset"
-            args['offset'] = offset
     cur = db.execute(cmd, args)
     return [_commit_from_row(row) for row in cur]
 
 
-def _ext_get_commit(db, repo, commit_hash):
-    cmd = "SELECT * FROM commits WHERE repo = :repo AND hash = :hash"
+def _ext_get_commit(db, repo, commit_hash, with_output):
+    cmd = ("SELECT repo, hash, change, status FROM commits "
+           "WHERE repo = :repo AND hash = :hash")
     args = {'repo': repo,
             'hash': commit_hash}
     cur = db.execute(cmd, args)
     row = cur.fetchone()
-    return _commit_from_row(row) if row else None
+    if not row:
+        return
+    commit = _commit_from_row(row)
+    if not with_output:
+        return commit
+    chunks = _ext_get_output_chunks(db, repo, commit_hash, 0, None)
+    output = b''.join(data for _, data in chunks)
+    return commit._replace(output=str(output, encoding='utf-8',
+                                      errors='ignore'))
+
+
+def _ext_get_output_chunks(db, repo, commit_hash, start, limit):
+    cmd = ("SELECT chunk, data FROM output_chunks "
+           "WHERE repo = :repo AND hash = :hash AND chunk >= :start "
+           "ORDER BY chunk")
+    args = {'repo': repo,
+            'hash': commit_hash,
+            'start': start}
+    if limit is not None:
+        cmd += " LIMIT :limit"
+        args['limit'] = limit
+    cur = db.execute(cmd, args)
+    return [(row[0], zlib.decompress(row[1])) for row in cur]
 
 
-def _ext_update_commit(db, commit):
-    cmd = ("INSERT OR REPLACE INTO commits VALUES "
-           "(:repo, :hash, :change, :status, :output)")
-    args = {'repo': commit.repo,
-            'hash': commit.hash,
-            'change': commit.change,
-            'status': commit.status.value,
-            'output': commit.output}
-    db.execute(cmd, args)
+def _ext_get_unknown_hashes(db, repo, commit_hashes):
+    commit_hashes = list(dict.fromkeys(commit_hashes))
+    known_hashes = set()
+
+    for i in range(0, len(commit_hashes), _max_query_params):
+        chunk = commit_hashes[i:i + _max_query_params]
+        cmd = (f"SELECT hash FROM commits "
+               f"WHERE repo = ? AND hash IN ({', '.join('?' * len(chunk))})")
+        cur = db.execute(cmd, [repo, *chunk])
+        known_hashes.update(row[0] for row in cur)
+
+    return [i for i in commit_hashes if i not in known_hashes]
+
+
+def _ext_get_status_counts(db):
+    cmd = "SELECT repo, status, count FROM status_counts WHERE count > 0"
+    cur = db.execute(cmd)
+    counts = collections.defaultdict(dict)
+    for repo, status, count in cur:
+        counts[repo][common.Status(status)] = count
+    return dict(counts)
+
+
+def _ext_get_refs(db):
+    cur = db.execute("SELECT repo, ref, hash FROM refs")
+    refs = collections.defaultdict(dict)
+    for repo, ref, commit_hash in cur:
+        refs[repo][ref] = commit_hash
+    return dict(refs)
+
+
+def _ext_update_refs(db, repo, refs, removed_refs):
+    with _ext_transaction(db):
+        db.executemany("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)",
+                       ((repo, ref, commit_hash)
+                        for ref, commit_hash in refs.items()))
+        db.executemany("DELETE FROM refs WHERE repo = ? AND ref = ?",
+                       ((repo, ref) for ref in removed_refs))
+
+
+def _ext_update_commits(db, commits):
+    with _ext_transaction(db):
+        for commit in commits:
+            old_status = _ext_get_status(db, commit.repo, commit.hash)
+            if old_status is not None:
+                _ext_update_status_count(db, commit.repo, old_status, -1)
+            _ext_update_status_count(db, commit.repo, commit.status.value, 1)
+
+            cmd = ("INSERT OR REPLACE INTO commits VALUES "
+                   "(:repo, :hash, :change, :status)")
+            args = {'repo': commit.repo,
+                    'hash': commit.hash,
+                    'change': commit.change,
+                    'status': commit.status.value}
+            db.execute(cmd, args)
+
+            if commit.output is not None:
+                _ext_set_output(db, commit.repo, commit.hash, commit.output)
 
 
 def _ext_remove_commit(db, commit):
-    cmd = "DELETE FROM commits WHERE repo = :repo AND hash = :hash"
+    with _ext_transaction(db):
+        _ext_delete_commit(db, commit)
+
+
+def _ext_prune_commits(db, repo, max_commits, min_change, limit):
+    args = {'repo': repo}
+    where = ["repo = :repo",
+             f"status NOT IN "
+             f"({', '.join(str(i.value) for i in _active_statuses)})"]
+
+    if min_change is not None:
+        where.append("change < :min_change")
+        args['min_change'] = min_change
+
+    if max_commits:
+        cmd = ("SELECT change, repo, hash FROM commits WHERE repo = :repo "
+               "ORDER BY change DESC, repo DESC, hash DESC "
+               "LIMIT 1 OFFSET :offset")
+        cur = db.execute(cmd, {'repo': repo,
+                               'offset': max_commits - 1})
+        row = cur.fetchone()
+        if not row:
+            return []
+
+        where.append("(change, repo, hash) < "
+                     "(:boundary_change, :boundary_repo, :boundary_hash)")
+        args['boundary_change'] = row[0]
+        args['boundary_repo'] = row[1]
+        args['boundary_hash'] = row[2]
+
+    elif max_commits is None and min_change is None:
+        return []
+
+    keep_hashes = set()
+    for status in common.Status:
+        cmd = ("SELECT hash FROM commits "
+               "WHERE repo = :repo AND status = :status "
+               "ORDER BY change DESC, repo DESC, hash DESC LIMIT 1")
+        cur = db.execute(cmd, {'repo': repo,
+                               'status': status.value})
+        keep_hashes.update(row[0] for row in cur)
+
+    cmd = (f"SELECT repo, hash, change, status FROM commits "
+           f"WHERE {' AND '.join(where)} "
+           f"ORDER BY change ASC, repo ASC, hash ASC LIMIT :limit")
+    args['limit'] = limit + len(keep_hashes)
+    cur = db.execute(cmd, args)
+    commits = [commit for commit in map(_commit_from_row, cur)
+               if commit.hash not in keep_hashes][:limit]
+
+    with _ext_transaction(db):
+        for commit in commits:
+            _ext_delete_commit(db, commit)
+
+    db.execute(f"PRAGMA incremental_vacuum({_vacuum_pages})").fetchall()
+    return commits
+
+
+def _ext_delete_commit(db, commit):
+    status = _ext_get_status(db, commit.repo, commit.hash)
+    if status is not None:
+        _ext_update_status_count(db, commit.repo, status, -1)
+
     args = {'repo': commit.repo,
             'hash': commit.hash}
+    db.execute("DELETE FROM commits WHERE repo = :repo AND hash = :hash",
+               args)
+    db.execute("DELETE FROM output_chunks "
+               "WHERE repo = :repo AND hash = :hash", args)
+
+
+def _ext_get_status(db, repo, commit_hash):
+    cmd = "SELECT status FROM commits WHERE repo = :repo AND hash = :hash"
+    args = {'repo': repo,
+            'hash': commit_hash}
+    cur = db.execute(cmd, args)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _ext_update_status_count(db, repo, status, delta):
+    cmd = ("INSERT INTO status_counts VALUES (:repo, :status, :delta) "
+           "ON CONFLICT (repo, status) DO UPDATE SET count = count + :delta")
+    args = {'repo': repo,
+            'status': status,
+            'delta': delta}
+    db.execute(cmd, args)
+
+
+def _ext_set_output(db, repo, commit_hash, output):
+    args = {'repo': repo,
+            'hash': commit_hash}
+    db.execute("DELETE FROM output_chunks "
+               "WHERE repo = :repo AND hash = :hash", args)
+
+    _ext_insert_output_chunks(db, repo, commit_hash, 0,
+                              output.encode('utf-8'))
+
+
+def _ext_append_output(db, repo, commit_hash, data, min_chunk):
+    cmd = ("SELECT chunk, data FROM output_chunks "
+           "WHERE repo = :repo AND hash = :hash "
+           "ORDER BY chunk DESC LIMIT 1")
+    args = {'repo': repo,
+            'hash': commit_hash}
+
+    with _ext_transaction(db):
+        cur = db.execute(cmd, args)
+        row = cur.fetchone()
+
+        if not row:
+            start = min_chunk
+
+        elif row[0] < min_chunk:
+            start = max(row[0] + 1, min_chunk)
+
+        else:
+            last_data = zlib.decompress(row[1])
+            if len(last_data) < output_chunk_size:
+                start = row[0]
+                data = last_data + data
+
+            else:
+                start = row[0] + 1
+
+        _ext_insert_output_chunks(db, repo, commit_hash, start, data)
+
+
+def _ext_set_output_chunk(db, repo, commit_hash, chunk, data):
+    cmd = ("INSERT INTO output_chunks VALUES "
+           "(:repo, :hash, :chunk, :data)")
+    args = {'repo': repo,
+            'hash': commit_hash,
+            'chunk': chunk,
+            'data': zlib.compress(data)}
     db.execute(cmd, args)
 
 
+def _ext_prune_output(db, repo, commit_hash, start, size):
+    cmd = ("SELECT max(chunk) FROM output_chunks "
+           "WHERE repo = :repo AND hash = :hash")
+    args = {'repo': repo,
+            'hash': commit_hash}
+    cur = db.execute(cmd, args)
+    row = cur.fetchone()
+    if row[0] is None:
+        return 0
+
+    # all chunks preceding last chunk contain output_chunk_size bytes
+    args['start'] = start
+    args['stop'] = row[0] + (-size // output_chunk_size)
+
+    with _ext_transaction(db):
+        cmd = ("SELECT data FROM output_chunks "
+               "WHERE repo = :repo AND hash = :hash AND "
+               "chunk >= :start AND chunk < :stop")
+        cur = db.execute(cmd, args)
+        pruned = sum(len(zlib.decompress(row[0])) for row in cur)
+        if not pruned:
+            return 0
+
+        db.execute("DELETE FROM output_chunks "
+                   "WHERE repo = :repo AND hash = :hash AND "
+                   "chunk >= :start AND chunk < :stop", args)
+
+        chunks = _ext_get_output_chunks(db, repo, commit_hash, start, 1)
+        if chunks:
+            chunk, data = chunks[0]
+            index = data.find(b'\n') + 1
+            if index:
+                _ext_set_output_chunk(db, repo, commit_hash, chunk,
+                                      data[index:])
+                pruned += index
+
+    return pruned
+
+
+def _ext_insert_output_chunks(db, repo, commit_hash, start, data):
+    for chunk, i in enumerate(range(0, len(data), output_chunk_size),
+                              start):
+        cmd = ("INSERT INTO output_chunks VALUES "
+               "(:repo, :hash, :chunk, :data)")
+        args = {'repo': repo,
+                'hash': commit_hash,
+                'chunk': chunk,
+                'data': zlib.compress(data[i:i + output_chunk_size])}
+        db.execute(cmd, args)
+
+
+@contextlib.contextmanager
+def _ext_transaction(db):
+    db.execute("BEGIN")
+    try:
+        yield
+        db.execute("COMMIT")
+
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def _ext_get_columns(db, table):
+    cur = db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cur}
+
+
+def _get_cursor(commit):
+    return common.Cursor(change=commit.change,
+                         repo=commit.repo,
+                         hash=commit.hash)
+
+
 def _commit_from_row(row):
     return common.Commit(repo=row[0],
                          hash=row[1],
                          change=row[2],
                          status=common.Status(row[3]),
-                         output=row[4])
+                         output=None)
@@ -0,0 +1,347 @@
+from pathlib import Path
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import shutil
+import subprocess
+import time
+import typing
+import uuid
+
+from hat import aio
+
+from boxhatter import common
+
+
+mlog: logging.Logger = logging.getLogger(__name__)
+
+current_link: str = 'current'
+
+generation_prefix: str = 'gen-'
+
+snapshot_prefix: str = 'tmp-'
+
+trash_dir: str = '.trash'
+
+
+async def create(path: Path,
+                 repos: typing.Iterable[str],
+                 max_size: typing.Optional[int] = None,
+                 repo_max_sizes: typing.Dict[str, typing.Optional[int]] = {},
+                 snapshots: typing.Iterable[Path] = []
+                 ) -> 'CacheManager':
+    manager = CacheManager()
+    manager._async_group = aio.Group()
+    manager._path = path
+    manager._trash_path = path / trash_dir
+    manager._max_size = max_size
+    manager._repo_max_sizes = repo_max_sizes
+    manager._delete_executor = aio.create_executor(1)
+    manager._size_executor = aio.create_executor(1)
+    manager._delete_event = asyncio.Event()
+    manager._reflink = False
+    manager._caches = {}
+    manager._sizes = {}
+    manager._snapshot_sizes = collections.defaultdict(dict)
+    manager._last_uses = {}
+
+    try:
+        manager._trash_path.mkdir(parents=True, exist_ok=True)
+
+        manager._reflink = await manager._size_executor(
+            _ext_check_reflink, manager._trash_path)
+        if not manager._reflink:
+            mlog.warning('reflink copies not supported by %s - cache '
+                         'snapshots are created as full copies', path)
+
+        manager._caches = {repo: _Cache(path / repo, manager._trash_path,
+                                        manager._reflink)
+                           for repo in repos}
+
+        for repo, cache in manager._caches.items():
+            await cache.init(snapshots)
+            manager._last_uses[repo] = cache.get_last_use()
+
+    except BaseException:
+        await aio.uncancellable(manager.async_close())
+        raise
+
+    manager.async_group.spawn(manager._delete_loop)
+    manager.async_group.spawn(manager._init_sizes)
+    manager._delete_event.set()
+
+    return manager
+
+
+class CacheManager(aio.Resource):
+
+    @property
+    def async_group(self) -> aio.Group:
+        return self._async_group
+
+    async def add_repo(self, repo: str):
+        if repo in self._caches:
+            return
+
+        cache = _Cache(self._path / repo, self._trash_path, self._reflink)
+        await cache.init([])
+        if repo in self._caches:
+            return
+
+        self._caches[repo] = cache
+        self._last_uses[repo] = cache.get_last_use()
+        await self._update_size(repo)
+
+    def get_usage(self, repo: str) -> common.CacheUsage:
+        return common.CacheUsage(size=self._get_size(repo),
+                                 last_use=self._last_uses.get(repo))
+
+    async def create_snapshot(self, repo: str) -> Path:
+        cache = self._caches[repo]
+        self._last_uses[repo] = time.time()
+        snapshot = await cache.create_snapshot()
+
+        self._snapshot_sizes[repo][snapshot] = await self._size_executor(
+            _ext_get_size, snapshot)
+        await self._enforce_quotas()
+
+        return snapshot
+
+    async def promote(self, repo: str, snapshot: Path):
+        cache = self._caches[repo]
+        self._snapshot_sizes[repo].pop(snapshot, None)
+        await cache.promote(snapshot)
+        self._delete_event.set()
+
+        await self._update_size(repo)
+        await self._enforce_quotas()
+
+    async def remove(self, repo: str, snapshot: Path):
+        cache = self._caches[repo]
+        self._snapshot_sizes[repo].pop(snapshot, None)
+        cache.remove(snapshot)
+        self._delete_event.set()
+
+    async def clear(self, repo: str):
+        cache = self._caches[repo]
+        await cache.clear()
+        self._sizes[repo] = 0
+        self._delete_event.set()
+
+    async def _init_sizes(self):
+        try:
+            for repo in self._caches.keys():
+                await self._update_size(repo)
+
+            await self._enforce_quotas()
+
+        except Exception:
+            self.close()
+            raise
+
+    def _get_size(self, repo):
+        size = self._sizes.get(repo)
+        if size is None:
+            return
+
+        return size + sum(self._snapshot_sizes[repo].values())
+
+    async def _update_size(self, repo):
+        path = self._caches[repo].get_current_path()
+        self._sizes[repo] = await self._size_executor(_ext_get_size, path)
+
+    async def _enforce_quotas(self):
+        for repo in list(self._sizes.keys()):
+            max_size = self._repo_max_sizes.get(repo)
+            if max_size is not None and self._get_size(repo) > max_size:
+                await self.clear(repo)
+
+        if self._max_size is None:
+            return
+
+        total_size = sum(self._get_size(repo) for repo in self._sizes.keys())
+        repos = sorted(self._sizes.keys(),
+                       key=lambda repo: self._last_uses.get(repo) or 0)
+
+        for repo in repos:
+            if total_size <= self._max_size:
+                break
+
+            size = self._sizes[repo]
+            if not size:
+                continue
+
+            await self.clear(repo)
+            total_size -= size
+
+    async def _delete_loop(self):
+        try:
+            while True:
+                await self._delete_event.wait()
+                self._delete_event.clear()
+
+                for path in list(self._trash_path.iterdir()):
+                    await self._delete_executor(shutil.rmtree, str(path),
+                                                True)
+
+        finally:
+            self.close()
+
+
+class _Cache:
+
+    def __init__(self, path, trash_path, reflink):
+        self._path = path
+        self._trash_path = trash_path
+        self._reflink = reflink
+        self._lock = asyncio.Lock()
+        self._copying = collections.Counter()
+
+    async def init(self, snapshots):
+        current_path = self._path / current_link
+        if self._path.exists() and not current_path.is_symlink():
+            legacy_path = self._trash_path / uuid.uuid4().hex
+            self._path.rename(legacy_path)
+            self._path.mkdir()
+            legacy_path.rename(self._path / f'{generation_prefix}0')
+            self._set_current(f'{generation_prefix}0')
+
+        elif not self._path.exists():
+            self._path.mkdir(parents=True)
+            (self._path / f'{generation_prefix}0').mkdir()
+            self._set_current(f'{generation_prefix}0')
+
+        snapshots = {snapshot.resolve() for snapshot in snapshots}
+        for path in list(self._path.glob(f'{snapshot_prefix}*')):
+            if path.resolve() not in snapshots:
+                self.remove(path)
+
+        self._remove_old_generations()
+
+    def get_current_path(self):
+        return self._path / self._get_current()
+
+    def get_last_use(self):
+        with contextlib.suppress(Exception):
+            return (self._path / current_link).lstat().st_mtime
+
+    async def create_snapshot(self):
+        async with self._lock:
+            generation = self._get_current()
+            snapshot = self._path / f'{snapshot_prefix}{uuid.uuid4().hex}'
+            self._copying[generation] += 1
+
+            with contextlib.suppress(Exception):
+                os.utime(self._path / current_link, follow_symlinks=False)
+
+        try:
+            await _copy_dir(self._path / generation, snapshot, self._reflink)
+
+        except BaseException:
+            self.remove(snapshot)
+            raise
+
+        finally:
+            self._copying[generation] -= 1
+            if not self._copying[generation]:
+                del self._copying[generation]
+                self._remove_old_generations()
+
+        return snapshot
+
+    async def promote(self, snapshot):
+        async with self._lock:
+            generation = self._get_next_generation()
+            snapshot.rename(self._path / generation)
+            self._set_current(generation)
+            self._remove_old_generations()
+
+    def remove(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            path.rename(self._trash_path / uuid.uuid4().hex)
+
+    async def clear(self):
+        async with self._lock:
+            generation = self._get_next_generation()
+            (self._path / generation).mkdir()
+            self._set_current(generation)
+            self._remove_old_generations()
+
+    def _get_current(self):
+        return os.readlink(self._path / current_link)
+
+    def _set_current(self, generation):
+        link_path = self._path / f'{current_link}.{uuid.uuid4().hex}'
+        link_path.symlink_to(generation)
+        os.replace(link_path, self._path / current_link)
+
+    def _get_next_generation(self):
+        generations = [int(path.name[len(generation_prefix):])
+                       for path in self._path.glob(f'{generation_prefix}*')
+                       if path.name[len(generation_prefix):].isdigit()]
+        return f'{generation_prefix}{max(generations, default=-1) + 1}'
+
+    def _remove_old_generations(self):
+        current = self._get_current()
+        for path in list(self._path.glob(f'{generation_prefix}*')):
+            if path.name != current and path.name not in self._copying:
+                self.remove(path)
+
+
+async def _copy_dir(src, dst, reflink):
+    p = await asyncio.create_subprocess_exec(
+        'cp', '-a', *(['--reflink=always'] if reflink else []),
+        str(src), str(dst),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+    try:
+        await p.wait()
+
+    finally:
+        if p.returncode is None:
+            p.terminate()
+            await p.wait()
+
+    if not p.returncode:
+        return
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, shutil.rmtree, str(dst), True)
+    await loop.run_in_executor(None, shutil.copytree, str(src), str(dst),
+                               True)
+
+
+def _ext_check_reflink(path):
+    src = path / f'{uuid.uuid4().hex}.reflink'
+    dst = path / f'{uuid.uuid4().hex}.reflink'
+
+    try:
+        src.write_bytes(b'reflink')
+        p = subprocess.run(['cp', '--reflink=always', str(src), str(dst)],
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        return not p.returncode
+
+    except Exception:
+        return False
+
+    finally:
+        for i in (src, dst):
+            with contextlib.suppress(FileNotFoundError):
+                i.unlink()
+
+
+def _ext_get_size(path):
+    size = 0
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            with contextlib.suppress(OSError):
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+
+    return size
@@ -22,6 +22,14 @@ class Status(enum.Enum):
     RUNNING = 1
     SUCCESS = 2
     FAILURE = 3
+    SUPERSEDED = 4
+
+
+class Priority(enum.Enum):
+    MANUAL = 0
+    WEBHOOK = 1
+    SYNC = 2
+    RECOVERY = 3
 
 
 class Commit(typing.NamedTuple):
@@ -29,7 +37,54 @@ class Commit(typing.NamedTuple):
     hash: str
     change: int
     status: Status
-    output: str
+    output: typing.Optional[str]
+
+
+class QueueItem(typing.NamedTuple):
+    repo: str
+    hash: str
+    priority: Priority
+
+
+class Push(typing.NamedTuple):
+    ref: str
+    hash: typing.Optional[str]
+
+
+class SyncState(typing.NamedTuple):
+    last_sync: float
+    duration: float
+    error: typing.Optional[str]
+
+
+class CacheUsage(typing.NamedTuple):
+    size: typing.Optional[int]
+    last_use: typing.Optional[float]
+
+
+class Job(typing.NamedTuple):
+    lease: str
+    repo: str
+    hash: str
+    url: str
+    action: str
+    env: typing.Dict[str, str]
+    cache_dst: str
+    timeout: typing.Optional[float]
+    lease_timeout: float
+
+
+class Container(typing.NamedTuple):
+    name: str
+    labels: typing.Dict[str, str]
+    workspace: Path
+    cache: typing.Optional[Path]
+
+
+class Cursor(typing.NamedTuple):
+    change: int
+    repo: str
+    hash: str
 
 
 class Settings(typing.NamedTuple):
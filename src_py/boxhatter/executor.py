@@ -0,0 +1,457 @@
+from pathlib import Path
+import abc
+import asyncio
+import contextlib
+import itertools
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import typing
+import uuid
+
+from hat import aio
+from hat import json
+
+from boxhatter import common
+import boxhatter.image
+import boxhatter.mirror
+
+
+read_size: int = 64 * 1024
+flush_delay: float = 1
+
+workspace_prefix: str = 'boxhatter-'
+
+workspace_label: str = 'boxhatter.workspace'
+
+cache_label: str = 'boxhatter.cache'
+
+job_label: str = 'boxhatter.job'
+
+
+class Output(abc.ABC):
+
+    @abc.abstractmethod
+    async def write(self, data: bytes):
+        pass
+
+    async def flush(self):
+        pass
+
+
+async def execute(action: str,
+                  env: typing.Dict[str, str],
+                  cache_src: typing.Optional[Path],
+                  cache_dst: str,
+                  url: str,
+                  ref: str,
+                  container_name: typing.Optional[str],
+                  output: Output,
+                  mirror: typing.Optional[boxhatter.mirror.Mirror] = None,
+                  image_manager: typing.Optional[
+                      boxhatter.image.ImageManager] = None,
+                  timeout: typing.Optional[float] = None,
+                  labels: typing.Optional[typing.Dict[str, str]] = None):
+    tmp_dir = mirror.path.parent if mirror else None
+    if tmp_dir:
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    repo_dir = Path(tempfile.mkdtemp(prefix=workspace_prefix, dir=tmp_dir))
+    container_name = container_name or f'boxhatter-{uuid.uuid4()}'
+    container_names = []
+    keep = False
+
+    try:
+        await asyncio.wait_for(
+            _execute(action=action,
+                     env=env,
+                     cache_src=cache_src,
+                     cache_dst=cache_dst,
+                     url=url,
+                     ref=ref,
+                     repo_dir=repo_dir,
+                     container_name=container_name,
+                     container_names=container_names,
+                     output=output,
+                     mirror=mirror,
+                     image_manager=image_manager,
+                     labels=labels),
+            timeout)
+
+    except asyncio.TimeoutError:
+        raise Exception(f'execution timed out after {timeout} seconds')
+
+    except asyncio.CancelledError:
+        keep = (labels is not None and
+                await aio.uncancellable(_containers_exist(container_names)))
+        raise
+
+    finally:
+        if not keep:
+            for name in container_names:
+                await aio.uncancellable(_remove_container(name))
+            await aio.uncancellable(_remove_dir(repo_dir))
+
+
+async def get_containers(labels: typing.Dict[str, str]
+                         ) -> typing.List[common.Container]:
+    stdout = await _engine('ps', '--all', '--format', '{{.Names}}',
+                           *itertools.chain.from_iterable(
+                               ('--filter', f'label={k}={v}')
+                               for k, v in labels.items()))
+
+    containers = []
+    for name in stdout.split():
+        with contextlib.suppress(Exception):
+            stdout = await _engine('inspect', '--format',
+                                   '{{json .Config.Labels}}', name)
+            container_labels = json.decode(stdout)
+            workspace = container_labels[workspace_label]
+            cache = container_labels.get(cache_label)
+            containers.append(common.Container(
+                name=name,
+                labels=container_labels,
+                workspace=Path(workspace),
+                cache=(Path(cache) if cache else None)))
+
+    return containers
+
+
+async def attach(container: common.Container,
+                 output: Output,
+                 timeout: typing.Optional[float] = None):
+    keep = False
+
+    try:
+        await asyncio.wait_for(_wait_container(container.name, output),
+                               timeout)
+
+    except asyncio.TimeoutError:
+        raise Exception(f'execution timed out after {timeout} seconds')
+
+    except asyncio.CancelledError:
+        keep = True
+        raise
+
+    finally:
+        if not keep:
+            await aio.uncancellable(remove(container))
+
+
+async def remove(container: common.Container):
+    await _remove_container(container.name)
+    await _remove_dir(container.workspace)
+
+
+async def _execute(action, env, cache_src, cache_dst, url, ref, repo_dir,
+                   container_name, container_names, output, mirror,
+                   image_manager, labels):
+    with contextlib.suppress(Exception):
+        path = Path(url)
+        if path.exists():
+            url = str(path.resolve())
+
+    if mirror:
+        await mirror.checkout(ref, repo_dir)
+
+    else:
+        await _run(['git', 'init', '-q'], repo_dir, output)
+        await _run(['git', 'remote', 'add', 'origin', url], repo_dir, output)
+        await _run(['git', 'fetch', '-q', '--depth=1', 'origin', ref],
+                   repo_dir, output)
+        await _run(['git', 'checkout', '-q', 'FETCH_HEAD'], repo_dir, output)
+
+    conf = json.decode_file(repo_dir / action)
+    common.json_schema_repo.validate('boxhatter://action.yaml#', conf)
+
+    repo_volume = f'{repo_dir}:/boxhatter'
+    cache_volume = (f'{cache_src.resolve()}:/boxhatter/{cache_dst}'
+                    if cache_src else None)
+    cache_lock = asyncio.Lock()
+
+    container_labels = {**(labels or {}),
+                        workspace_label: str(repo_dir)}
+    if cache_src:
+        container_labels[cache_label] = str(cache_src.resolve())
+
+    async def run_container(name, job, output):
+        job_container_name = (f'{container_name}-{name}' if name
+                              else container_name)
+        job_labels = ({**container_labels, job_label: name} if name
+                      else container_labels)
+
+        async def run(volumes):
+            await _run_container(
+                container_name=job_container_name,
+                container_names=container_names,
+                image=job['image'],
+                command=job['command'],
+                timeout=job.get('timeout', conf.get('timeout')),
+                volumes=volumes,
+                env=env,
+                labels=job_labels,
+                output=output,
+                image_manager=image_manager)
+
+        if not cache_volume or not job.get('cache', True):
+            await run([repo_volume])
+            return
+
+        # jobs sharing cache snapshot are not executed concurrently
+        async with cache_lock:
+            await run([repo_volume, cache_volume])
+
+    if 'jobs' in conf:
+        await _run_jobs(_sort_jobs(conf['jobs']), run_container, output)
+
+    else:
+        await run_container(None, conf, output)
+
+
+async def _run_jobs(jobs, run_container, output):
+    lock = asyncio.Lock()
+    pending = dict(jobs)
+    running = {}
+    results = {}
+    durations = {}
+
+    async def run_job(name, job):
+        job_output = _JobOutput(output, name, lock)
+        start = time.monotonic()
+
+        try:
+            await run_container(name, job, job_output)
+            return 'success'
+
+        except Exception as e:
+            await job_output.write(f'{e}\n'.encode('utf-8'))
+            return 'failure'
+
+        finally:
+            durations[name] = time.monotonic() - start
+            await job_output.finish()
+
+    try:
+        while pending or running:
+            for name, job in list(pending.items()):
+                needs = job.get('needs', [])
+
+                if any(results.get(i, 'success') != 'success'
+                       for i in needs):
+                    del pending[name]
+                    results[name] = 'skipped'
+
+                elif all(i in results for i in needs):
+                    del pending[name]
+                    task = asyncio.ensure_future(run_job(name, job))
+                    running[task] = name
+
+            if not running:
+                continue
+
+            done, _ = await asyncio.wait(running.keys(),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[running.pop(task)] = task.result()
+
+    finally:
+        for task in running:
+            task.cancel()
+
+        if running:
+            await aio.uncancellable(asyncio.wait(running.keys()))
+
+    summary = ''.join(
+        f'    {name}: {results[name]}' +
+        (f' ({durations[name]:.2f}s)' if name in durations else '') + '\n'
+        for name in jobs)
+    await output.write(f'jobs:\n{summary}'.encode('utf-8'))
+
+    failed = [name for name in jobs if results[name] != 'success']
+    if failed:
+        raise Exception(f'unsuccessful jobs: {", ".join(failed)}')
+
+
+def _sort_jobs(jobs):
+    for name, job in jobs.items():
+        for i in job.get('needs', []):
+            if i not in jobs:
+                raise Exception(f'job {name} needs unknown job {i}')
+
+    result = {}
+    while len(result) < len(jobs):
+        ready = [name for name, job in jobs.items()
+                 if name not in result and
+                 all(i in result for i in job.get('needs', []))]
+        if not ready:
+            raise Exception('job dependencies contain cycle')
+
+        for name in ready:
+            result[name] = jobs[name]
+
+    return result
+
+
+async def _run_container(container_name, container_names, image, command,
+                         timeout, volumes, env, labels, output,
+                         image_manager):
+    if image_manager:
+        pull_duration = await image_manager.ensure(image)
+        if pull_duration is not None:
+            await output.write(f'pulled image {image} in '
+                               f'{pull_duration:.2f}s\n'.encode('utf-8'))
+
+    container_names.append(container_name)
+
+    script = f'set -e\ncd /boxhatter\n{command}\n'
+    await _engine('run', '--detach',
+                  '--name', container_name,
+                  *itertools.chain.from_iterable(
+                      ('--label', f'{k}={v}') for k, v in labels.items()),
+                  *itertools.chain.from_iterable(('-v', i) for i in volumes),
+                  *itertools.chain.from_iterable(('--env', i) for i in env),
+                  image, '/bin/sh', '-c', script,
+                  env=env)
+
+    try:
+        await asyncio.wait_for(_wait_container(container_name, output),
+                               timeout)
+
+    except asyncio.TimeoutError:
+        await aio.uncancellable(_remove_container(container_name))
+        raise Exception(f'action timed out after {timeout} seconds')
+
+
+async def _wait_container(container_name, output):
+    await _run([common.settings.engine, 'logs', '--follow', container_name],
+               None, output)
+
+    stdout = await _engine('wait', container_name)
+    returncode = int(stdout.strip().split()[-1])
+    if returncode:
+        raise Exception(f'{common.settings.engine} failed with exit code '
+                        f'{returncode}')
+
+
+async def _run(cmd, cwd, output, env={}, stdin=None):
+    p = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=(str(cwd) if cwd else None),
+        stdin=(subprocess.PIPE if stdin is not None else subprocess.DEVNULL),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env={**os.environ, **env})
+
+    try:
+        if stdin is not None:
+            p.stdin.write(stdin)
+            with contextlib.suppress(ConnectionError):
+                await p.stdin.drain()
+            p.stdin.close()
+
+        while True:
+            try:
+                data = await asyncio.wait_for(p.stdout.read(read_size),
+                                              flush_delay)
+
+            except asyncio.TimeoutError:
+                await output.flush()
+                continue
+
+            if not data:
+                break
+
+            await output.write(data)
+
+        await p.wait()
+
+        if p.returncode:
+            raise Exception(f'{cmd[0]} failed with exit code '
+                            f'{p.returncode}')
+
+    finally:
+        if p.returncode is None:
+            p.terminate()
+
+
+async def _engine(*args, env={}):
+    p = await asyncio.create_subprocess_exec(
+        common.settings.engine, *args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env={**os.environ, **env})
+
+    try:
+        stdout, stderr = await p.communicate()
+        if p.returncode:
+            stderr = str(stderr, encoding='utf-8', errors='ignore')
+            raise Exception(f'{common.settings.engine} {args[0]} failed: '
+                            f'{stderr.strip()}')
+
+        return str(stdout, encoding='utf-8', errors='ignore')
+
+    finally:
+        if p.returncode is None:
+            p.terminate()
+
+
+async def _containers_exist(container_names):
+    for container_name in container_names:
+        with contextlib.suppress(Exception):
+            await _engine('container', 'inspect', container_name)
+            return True
+
+    return False
+
+
+async def _remove_container(container_name):
+    cmd = [common.settings.engine, 'rm', '--force', container_name]
+
+    p = await asyncio.create_subprocess_exec(*cmd,
+                                             stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL)
+    await p.wait()
+
+
+class _JobOutput(Output):
+
+    def __init__(self, output, name, lock):
+        self._output = output
+        self._prefix = f'[{name}] '.encode('utf-8')
+        self._lock = lock
+        self._data = bytearray()
+
+    async def write(self, data):
+        self._data.extend(data)
+
+        index = self._data.rfind(b'\n') + 1
+        if not index and len(self._data) >= read_size:
+            self._data.extend(b'\n')
+            index = len(self._data)
+
+        if not index:
+            return
+
+        lines = bytes(self._data[:index - 1]).split(b'\n')
+        del self._data[:index]
+
+        async with self._lock:
+            await self._output.write(
+                b''.join(self._prefix + line + b'\n' for line in lines))
+
+    async def flush(self):
+        async with self._lock:
+            await self._output.flush()
+
+    async def finish(self):
+        if self._data:
+            await self.write(b'\n')
+
+
+async def _remove_dir(path):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, shutil.rmtree, str(path), True)
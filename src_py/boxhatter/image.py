@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import subprocess
+import time
+import typing
+
+from hat import aio
+
+from boxhatter import common
+
+
+async def create(refresh_delay: typing.Optional[float] = None
+                 ) -> 'ImageManager':
+    manager = ImageManager()
+    manager._async_group = aio.Group()
+    manager._pulls = {}
+    manager._images = set()
+    manager._used_images = set()
+
+    if refresh_delay is not None:
+        manager.async_group.spawn(manager._refresh_loop, refresh_delay)
+
+    return manager
+
+
+class ImageManager(aio.Resource):
+
+    @property
+    def async_group(self) -> aio.Group:
+        return self._async_group
+
+    def prepare(self, image: str):
+        self.async_group.spawn(self._prepare, image)
+
+    async def ensure(self, image: str) -> typing.Optional[float]:
+        self._used_images.add(image)
+
+        if image in self._images:
+            return
+
+        if image not in self._pulls and await _image_exists(image):
+            self._images.add(image)
+            return
+
+        return await self.pull(image)
+
+    async def pull(self, image: str) -> float:
+        future = self._pulls.get(image)
+        if not future:
+            future = asyncio.get_running_loop().create_future()
+            self._pulls[image] = future
+            self.async_group.spawn(self._pull, image, future)
+
+        return await asyncio.shield(future)
+
+    async def _prepare(self, image):
+        with contextlib.suppress(Exception):
+            await self.ensure(image)
+
+    async def _pull(self, image, future):
+        try:
+            start = time.monotonic()
+            await _pull_image(image)
+            self._images.add(image)
+            future.set_result(time.monotonic() - start)
+
+        except Exception as e:
+            future.set_exception(e)
+
+        finally:
+            del self._pulls[image]
+            if not future.done():
+                future.cancel()
+
+    async def _refresh_loop(self, refresh_delay):
+        try:
+            while True:
+                await asyncio.sleep(refresh_delay)
+
+                images, self._used_images = self._used_images, set()
+                for image in images:
+                    with contextlib.suppress(Exception):
+                        await self.pull(image)
+
+        finally:
+            self.close()
+
+
+async def _image_exists(image):
+    cmd = [common.settings.engine, 'image', 'inspect', image]
+    p = await asyncio.create_subprocess_exec(*cmd,
+                                             stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL)
+
+    try:
+        return not await p.wait()
+
+    finally:
+        if p.returncode is None:
+            p.terminate()
+
+
+async def _pull_image(image):
+    cmd = [common.settings.engine, 'pull', '--quiet', image]
+    p = await asyncio.create_subprocess_exec(*cmd,
+                                             stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.PIPE)
+
+    try:
+        _, stderr = await p.communicate()
+        if p.returncode:
+            stderr = str(stderr, encoding='utf-8', errors='ignore')
+            raise Exception(f'pulling image {image} failed: '
+                            f'{stderr.strip()}')
+
+    finally:
+        if p.returncode is None:
+            p.terminate()
@@ -1,11 +1,10 @@
 from pathlib import Path
 import asyncio
 import contextlib
-import itertools
 import logging.config
-import subprocess
+import os
+import socket
 import sys
-import tempfile
 import typing
 
 from hat import aio
@@ -15,8 +14,10 @@ import click
 
 from boxhatter import common
 import boxhatter.backend
+import boxhatter.executor
 import boxhatter.server
 import boxhatter.ui
+import boxhatter.worker
 
 
 user_config_dir: Path = Path(appdirs.user_config_dir('boxhatter'))
@@ -26,6 +27,7 @@ user_cache_dir: Path = Path(appdirs.user_cache_dir('boxhatter'))
 default_conf_path: Path = user_config_dir / 'server.yaml'
 default_db_path: Path = user_data_dir / 'server.db'
 default_cache_path: Path = user_cache_dir
+default_worker_cache_path: Path = user_cache_dir / 'worker'
 
 
 @click.group()
@@ -73,56 +75,28 @@ def main(log_level: str,
               help="path to persisted cache folder")
 @click.option('--cache-dst', metavar='PATH', default='.boxhatter_cache',
               help="relative path to cache folder inside repository")
+@click.option('--container-name', default=None,
+              help="container name")
 @click.argument('url', required=True)
 @click.argument('ref', required=False, default='HEAD')
 def execute(action: str,
             env: typing.Tuple[str],
             cache_src: typing.Optional[Path],
             cache_dst: str,
+            container_name: typing.Optional[str],
             url: str,
             ref: str):
-    with contextlib.suppress(Exception):
-        path = Path(url)
-        if path.exists():
-            url = str(path.resolve())
+    env = {name: (value if sep else os.environ.get(name, ''))
+           for name, sep, value in (i.partition('=') for i in env)}
 
-    with tempfile.TemporaryDirectory() as repo_dir:
-        repo_dir = Path(repo_dir)
-
-        subprocess.run(['git', 'init', '-q'],
-                       cwd=str(repo_dir),
-                       check=True)
-
-        subprocess.run(['git', 'remote', 'add', 'origin', url],
-                       cwd=str(repo_dir),
-                       check=True)
-
-        subprocess.run(['git', 'fetch', '-q', '--depth=1', 'origin', ref],
-                       cwd=str(repo_dir),
-                       check=True)
-
-        subprocess.run(['git', 'checkout', '-q', 'FETCH_HEAD'],
-                       cwd=str(repo_dir),
-                       check=True)
-
-        conf = json.decode_file(repo_dir / action)
-        common.json_schema_repo.validate('boxhatter://action.yaml#', conf)
-
-        volumes = [f'{repo_dir}:/boxhatter']
-        if cache_src:
-            volumes.append(f'{cache_src.resolve()}:/boxhatter/{cache_dst}')
-
-        image = conf['image']
-        command = conf['command']
-
-        cmd = [common.settings.engine, 'run', '-i', '--rm',
-               *itertools.chain.from_iterable(('-v', i) for i in volumes),
-               *itertools.chain.from_iterable(('--env', i) for i in env),
-               image, '/bin/sh']
-        subprocess.run(cmd,
-                       input=f'set -e\ncd /boxhatter\n{command}\n',
-                       encoding='utf-8',
-                       check=True)
+    aio.run_asyncio(boxhatter.executor.execute(action=action,
+                                               env=env,
+                                               cache_src=cache_src,
+                                               cache_dst=cache_dst,
+                                               url=url,
+                                               ref=ref,
+                                               container_name=container_name,
+                                               output=_StdoutOutput()))
 
 
 @main.command()
@@ -136,30 +110,41 @@ def execute(action: str,
 @click.option('--db', default=default_db_path, metavar='PATH', type=Path,
               help="sqlite database path "
                    "(default $XDG_DATA_HOME/boxhatter/server.db")
+@click.option('--db-readers', default=4, type=click.IntRange(min=1),
+              help="number of concurrent database reader connections "
+                   "(default 4)")
+@click.option('--db-cache-size', default=500, type=click.IntRange(min=1),
+              help="number of recent commits cached in memory (default 500)")
 @click.option('--cache', default=default_cache_path, metavar='PATH', type=Path,
               help="persisted cache path (default $XDG_CACHE_HOME/boxhatter")
 def server(host: str,
            port: int,
            conf: Path,
            db: Path,
+           db_readers: int,
+           db_cache_size: int,
            cache: Path):
     conf = json.decode_file(conf)
     common.json_schema_repo.validate('boxhatter://server.yaml#', conf)
     cache.mkdir(parents=True, exist_ok=True)
 
     with contextlib.suppress(asyncio.CancelledError):
-        aio.run_asyncio(async_server(host, port, conf, db, cache))
+        aio.run_asyncio(async_server(host, port, conf, db, db_readers,
+                                     db_cache_size, cache))
 
 
 async def async_server(host: str,
                        port: int,
                        conf: json.Data,
                        db_path: Path,
+                       db_readers_count: int,
+                       db_cache_size: int,
                        cache_path: Path):
     async_group = aio.Group()
 
     try:
-        backend = await boxhatter.backend.create(db_path)
+        backend = await boxhatter.backend.create(db_path, db_readers_count,
+                                                 db_cache_size)
         _bind_resource(async_group, backend)
 
         server = await boxhatter.server.create(conf, cache_path, backend)
@@ -174,6 +159,62 @@ async def async_server(host: str,
         await aio.uncancellable(async_group.async_close())
 
 
+@main.command()
+@click.option('--server', 'server_url', required=True, metavar='URL',
+              help="server address (e.g. http://localhost:24000)")
+@click.option('--token', required=True, envvar='BOXHATTER_WORKER_TOKEN',
+              help="worker authentication token "
+                   "(default $BOXHATTER_WORKER_TOKEN)")
+@click.option('--name', default=socket.gethostname(),
+              help="worker name (default host name)")
+@click.option('--parallel', default=1, type=click.IntRange(min=1),
+              help="number of concurrent executions (default 1)")
+@click.option('--cache', default=default_worker_cache_path, metavar='PATH',
+              type=Path,
+              help="repository mirrors and caches path "
+                   "(default $XDG_CACHE_HOME/boxhatter/worker)")
+def worker(server_url: str,
+           token: str,
+           name: str,
+           parallel: int,
+           cache: Path):
+    cache.mkdir(parents=True, exist_ok=True)
+
+    with contextlib.suppress(asyncio.CancelledError):
+        aio.run_asyncio(async_worker(server_url, token, name, parallel,
+                                     cache))
+
+
+async def async_worker(server_url: str,
+                       token: str,
+                       name: str,
+                       parallel: int,
+                       cache_path: Path):
+    async_group = aio.Group()
+
+    try:
+        worker = await boxhatter.worker.create(url=server_url,
+                                               token=token,
+                                               name=name,
+                                               cache_path=cache_path,
+                                               parallel=parallel)
+        _bind_resource(async_group, worker)
+
+        await async_group.wait_closing()
+
+    finally:
+        await aio.uncancellable(async_group.async_close())
+
+
+class _StdoutOutput(boxhatter.executor.Output):
+
+    async def write(self, data):
+        sys.stdout.buffer.write(data)
+
+    async def flush(self):
+        sys.stdout.buffer.flush()
+
+
 def _bind_resource(async_group, resource):
     async_group.spawn(aio.call_on_cancel, resource.async_close)
     async_group.spawn(aio.call_on_done, resource.wait_closing(),
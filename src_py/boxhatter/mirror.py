@@ -0,0 +1,229 @@
+from pathlib import Path
+import asyncio
+import contextlib
+import fcntl
+import os
+import re
+import subprocess
+import typing
+import uuid
+
+
+ref_namespace: str = 'refs/boxhatter/'
+
+fetch_namespace: str = 'refs/boxhatter-fetch/'
+
+lock_poll_delay: float = 0.1
+
+_hash_re = re.compile(r'^[0-9a-f]{40}$')
+
+
+class Mirror:
+
+    def __init__(self, path: Path, url: str):
+        with contextlib.suppress(Exception):
+            local_path = Path(url)
+            if local_path.exists():
+                url = str(local_path.resolve())
+
+        self._path = path.resolve()
+        self._url = url
+        self._lock = _Lock(self._path.parent / f'{self._path.name}.lock')
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    async def update(self, refs: typing.Dict[str, str]):
+        refs = {ref: commit_hash for ref, commit_hash in refs.items()
+                if not ref.endswith('^{}')}
+
+        async with self._lock.exclusive():
+            await self._init()
+
+            mirror_refs = await self._get_refs()
+            fetch_refs = [ref for ref, commit_hash in refs.items()
+                          if mirror_refs.get(ref) != commit_hash]
+            delete_refs = [ref for ref in mirror_refs if ref not in refs]
+
+            if fetch_refs:
+                await _git(self._path, 'fetch', '-q', '--no-tags',
+                           self._url,
+                           *(f'+{ref}:{ref_namespace}{ref}'
+                             for ref in fetch_refs))
+
+            if delete_refs:
+                await _git(self._path, 'update-ref', '--stdin',
+                           stdin=''.join(f'delete {ref_namespace}{ref}\n'
+                                         for ref in delete_refs))
+
+    async def checkout(self, ref: str, dst: Path):
+        async with self._lock.shared():
+            commit_hash = await self._resolve(ref)
+
+        fetch_ref = None
+
+        try:
+            if not commit_hash:
+                async with self._lock.exclusive():
+                    await self._init()
+                    commit_hash = await self._resolve(ref)
+
+                    if not commit_hash:
+                        fetch_ref = f'{fetch_namespace}{uuid.uuid4().hex}'
+                        await _git(self._path, 'fetch', '-q', '--no-tags',
+                                   self._url, f'+{ref}:{fetch_ref}')
+                        commit_hash = await self._resolve(fetch_ref)
+
+            if not commit_hash:
+                raise Exception(f'reference {ref} not found')
+
+            if _hash_re.match(ref) and commit_hash != ref:
+                raise Exception(f'reference {ref} resolved to {commit_hash}')
+
+            async with self._lock.shared():
+                await _git(dst.parent, 'clone', '-q', '--no-checkout',
+                           str(self._path), str(dst))
+
+        finally:
+            if fetch_ref:
+                async with self._lock.exclusive():
+                    with contextlib.suppress(Exception):
+                        await _git(self._path, 'update-ref', '-d', fetch_ref)
+
+        await _git(dst, 'remote', 'set-url', 'origin', self._url)
+        await _git(dst, 'checkout', '-q', '--detach', commit_hash)
+
+    async def read_file(self,
+                        commit_hash: str,
+                        path: str
+                        ) -> typing.Optional[str]:
+        async with self._lock.shared():
+            if not (self._path / 'HEAD').exists():
+                return
+
+            with contextlib.suppress(Exception):
+                return await _git(self._path, 'show',
+                                  f'{commit_hash}:{path}')
+
+    async def _init(self):
+        if (self._path / 'HEAD').exists():
+            return
+
+        self._path.mkdir(parents=True, exist_ok=True)
+        await _git(self._path, 'init', '-q', '--bare')
+        await _git(self._path, 'config', 'gc.autoDetach', 'false')
+
+    async def _get_refs(self):
+        stdout = await _git(self._path, 'for-each-ref',
+                            '--format=%(objectname) %(refname)',
+                            ref_namespace)
+
+        refs = {}
+        for line in stdout.split('\n'):
+            segments = line.split(maxsplit=1)
+            if len(segments) < 2:
+                continue
+            refs[segments[1][len(ref_namespace):]] = segments[0]
+
+        return refs
+
+    async def _resolve(self, ref):
+        if not (self._path / 'HEAD').exists():
+            return
+
+        with contextlib.suppress(Exception):
+            stdout = await _git(self._path, 'rev-parse', '--verify', '-q',
+                                f'{ref}^{{commit}}')
+            return stdout.strip()
+
+
+class _Lock:
+
+    def __init__(self, path):
+        self._path = path
+        self._condition = asyncio.Condition()
+        self._shared_count = 0
+        self._exclusive_count = 0
+        self._exclusive = False
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self._exclusive and not self._exclusive_count)
+            self._shared_count += 1
+
+        try:
+            async with _flock(self._path, fcntl.LOCK_SH):
+                yield
+
+        finally:
+            async with self._condition:
+                self._shared_count -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self._condition:
+            self._exclusive_count += 1
+            try:
+                await self._condition.wait_for(
+                    lambda: not self._exclusive and not self._shared_count)
+
+            finally:
+                self._exclusive_count -= 1
+                self._condition.notify_all()
+
+            self._exclusive = True
+
+        try:
+            async with _flock(self._path, fcntl.LOCK_EX):
+                yield
+
+        finally:
+            async with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+@contextlib.asynccontextmanager
+async def _flock(path, operation):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                break
+
+            except BlockingIOError:
+                await asyncio.sleep(lock_poll_delay)
+
+        yield
+
+    finally:
+        os.close(fd)
+
+
+async def _git(cwd, *args, stdin=None):
+    p = await asyncio.create_subprocess_exec(
+        'git', *args,
+        cwd=str(cwd),
+        stdin=(subprocess.PIPE if stdin is not None else subprocess.DEVNULL),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+    try:
+        stdout, stderr = await p.communicate(
+            stdin.encode('utf-8') if stdin is not None else None)
+        if p.returncode:
+            stderr = str(stderr, encoding='utf-8', errors='ignore')
+            raise Exception(f'git {args[0]} failed: {stderr.strip()}')
+
+        return str(stdout, encoding='utf-8', errors='ignore')
+
+    finally:
+        if p.returncode is None:
+            p.terminate()
@@ -2,12 +2,12 @@ from pathlib import Path
 import asyncio
 import collections
 import contextlib
+import fnmatch
+import hmac
 import itertools
 import multiprocessing
-import os
-import shutil
+import random
 import subprocess
-import sys
 import time
 import typing
 import uuid
@@ -17,6 +17,26 @@ from hat import json
 
 from boxhatter import common
 import boxhatter.backend
+import boxhatter.cache
+import boxhatter.executor
+import boxhatter.image
+import boxhatter.mirror
+import boxhatter.webhook
+
+
+prune_batch_size: int = 100
+
+prune_batch_delay: float = 0.1
+
+output_flush_delay: float = 1
+
+mirrors_dir: str = '.mirrors'
+
+server_label: str = 'boxhatter.server'
+
+repo_label: str = 'boxhatter.repo'
+
+commit_label: str = 'boxhatter.commit'
 
 
 async def create(conf: json.Data,
@@ -29,32 +49,117 @@ async def create(conf: json.Data,
     server._backend = backend
     server._async_group = aio.Group()
     server._repos = set(conf['repos'].keys())
-    server._run_queue = aio.Queue()
-    server._sync_events = {}
+    server._scheduler = _Scheduler(
+        max_parallel=conf.get('max_parallel', multiprocessing.cpu_count()),
+        repo_max_parallel={repo: repo_conf.get('max_parallel')
+                           for repo, repo_conf in conf['repos'].items()},
+        repo_weights={repo: repo_conf.get('weight', 1)
+                      for repo, repo_conf in conf['repos'].items()})
+    server._sync_scheduler = _SyncScheduler(
+        repo_sync_delays={repo: (repo_conf.get('min_sync_delay', 60) or 0,
+                                 repo_conf.get('max_sync_delay'))
+                          for repo, repo_conf in conf['repos'].items()},
+        max_parallel=conf.get('max_parallel_syncs', 4),
+        jitter=conf.get('sync_jitter', 0.1),
+        retry_delay=conf.get('sync_retry_delay', 10),
+        max_retry_delay=conf.get('max_sync_retry_delay', 3600))
+    server._sync_states = {}
+    server._webhook_syncs = set()
+    server._refs = await backend.get_refs()
+    server._refs_versions = collections.Counter()
+    server._refs_locks = collections.defaultdict(asyncio.Lock)
+    server._runs = {}
+    server._leases = {}
+    server._mirrors = {
+        repo: boxhatter.mirror.Mirror(cache_path / mirrors_dir / repo,
+                                      repo_conf['url'])
+        for repo, repo_conf in conf['repos'].items()}
 
-    for repo, repo_conf in conf['repos'].items():
-        sync_event = asyncio.Event()
-        server._sync_events[repo] = sync_event
-        server.async_group.spawn(server._sync_loop, repo, repo_conf,
-                                 sync_event)
+    try:
+        containers = await boxhatter.executor.get_containers(
+            {server_label: str(backend.server_uuid)})
 
-    for _ in range(multiprocessing.cpu_count()):
-        server.async_group.spawn(server._run_loop)
+    except Exception:
+        containers = []
 
     try:
+        server._cache_manager = await boxhatter.cache.create(
+            path=cache_path,
+            repos=conf['repos'].keys(),
+            max_size=_get_cache_size(conf.get('max_cache_size')),
+            repo_max_sizes={
+                repo: _get_cache_size(repo_conf.get('max_cache_size'))
+                for repo, repo_conf in conf['repos'].items()},
+            snapshots=[container.cache for container in containers
+                       if container.cache])
+        server.async_group.spawn(aio.call_on_cancel,
+                                 server._cache_manager.async_close)
+        server.async_group.spawn(aio.call_on_done,
+                                 server._cache_manager.wait_closing(),
+                                 server.close)
+
+        server._image_manager = await boxhatter.image.create(
+            conf.get('image_refresh_delay'))
+        server.async_group.spawn(aio.call_on_cancel,
+                                 server._image_manager.async_close)
+        server.async_group.spawn(aio.call_on_done,
+                                 server._image_manager.wait_closing(),
+                                 server.close)
+
+        server.async_group.spawn(server._sync_loop)
+
+        if conf.get('local_execution', True):
+            server.async_group.spawn(server._run_loop)
+
+        server.async_group.spawn(server._prune_loop)
+
         commits = await backend.get_commits(repo=None,
                                             statuses={common.Status.PENDING,
                                                       common.Status.RUNNING},
                                             order=common.Order.ASC,
                                             limit=None,
-                                            offset=None)
+                                            cursor=None)
+
+        commit_containers = collections.defaultdict(list)
+        for container in containers:
+            key = (container.labels.get(repo_label),
+                   container.labels.get(commit_label))
+            commit_containers[key].append(container)
+
+        reattached_commits = collections.deque()
+        pending_commits = collections.deque()
 
         for commit in commits:
-            commit = commit._replace(change=int(time.time()),
-                                     status=common.Status.PENDING,
-                                     output='')
-            await backend.update_commit(commit)
-            server._run_queue.put_nowait(commit)
+            key = commit.repo, commit.hash
+            containers = commit_containers.get(key, [])
+            job_label = boxhatter.executor.job_label
+            if (len(containers) == 1 and
+                    job_label not in containers[0].labels and
+                    commit.status == common.Status.RUNNING and
+                    commit.repo in server._repos):
+                del commit_containers[key]
+                reattached_commits.append((commit, containers[0]))
+
+            else:
+                pending_commits.append(
+                    commit._replace(change=int(time.time()),
+                                    status=common.Status.PENDING,
+                                    output=''))
+
+        await backend.update_commits(pending_commits)
+
+        for (repo, _), containers in commit_containers.items():
+            for container in containers:
+                await boxhatter.executor.remove(container)
+                if container.cache and repo in server._repos:
+                    await server._cache_manager.remove(repo, container.cache)
+
+        for commit, container in reattached_commits:
+            server._scheduler.acquire(commit)
+            server.async_group.spawn(server._run, commit, container=container)
+
+        for commit in pending_commits:
+            server._scheduler.put(commit, common.Priority.RECOVERY)
 
     except BaseException:
         await aio.uncancellable(server.async_close())
@@ -79,150 +184,862 @@ class Server(aio.Resource):
 
     async def get_commits(self,
                           repo: typing.Optional[str],
+                          order: common.Order,
                           limit: typing.Optional[int],
-                          offset: typing.Optional[int]
+                          cursor: typing.Optional[common.Cursor]
                           ) -> typing.List[common.Commit]:
         return await self._backend.get_commits(repo=repo,
                                                statuses=None,
-                                               order=common.Order.DESC,
+                                               order=order,
                                                limit=limit,
-                                               offset=offset)
+                                               cursor=cursor)
+
+    async def get_status_counts(self) -> boxhatter.backend.StatusCounts:
+        return await self._backend.get_status_counts()
 
     async def get_commit(self,
                          repo: str,
-                         commit_hash: str
+                         commit_hash: str,
+                         with_output: bool = True
                          ) -> typing.Optional[common.Commit]:
-        return await self._backend.get_commit(repo, commit_hash)
+        return await self._backend.get_commit(repo, commit_hash, with_output)
+
+    def get_output(self,
+                   repo: str,
+                   commit_hash: str,
+                   follow: bool = False
+                   ) -> typing.AsyncIterable[str]:
+        return self._backend.get_output(repo, commit_hash, follow)
+
+    def get_queue(self) -> typing.List[common.QueueItem]:
+        return self._scheduler.get_items()
+
+    def get_refs(self, repo: str) -> typing.Dict[str, str]:
+        return dict(self._refs.get(repo, {}))
+
+    def get_sync_states(self) -> typing.Dict[str, common.SyncState]:
+        return dict(self._sync_states)
 
     async def run_commit(self,
                          repo: str,
                          commit_hash: str
                          ) -> common.Commit:
-        commit = common.Commit(repo=repo,
-                               hash=commit_hash,
-                               change=int(time.time()),
-                               status=common.Status.PENDING,
-                               output='')
-        await self._backend.update_commit(commit)
-        self._run_queue.put_nowait(commit)
-        return commit
+        commits = await self._run_commits(repo, [commit_hash],
+                                          common.Priority.MANUAL)
+        return commits[0]
+
+    def get_cache_usage(self, repo: str) -> common.CacheUsage:
+        return self._cache_manager.get_usage(repo)
 
     async def clear_cache(self, repo: str):
-        # TODO run in executor
-        shutil.rmtree(str(self._cache_path / repo), ignore_errors=True)
+        await self._cache_manager.clear(repo)
 
     def sync_repo(self, repo: str):
-        self._sync_events[repo].set()
+        self._webhook_syncs.add(repo)
+        self._sync_scheduler.request(repo)
+
+    async def process_webhook(self,
+                              repo: str,
+                              headers: boxhatter.webhook.Headers,
+                              body: bytes
+                              ) -> bool:
+        repo_conf = self._conf['repos'][repo]
+        secret = repo_conf.get('webhook_secret')
+        if secret is None:
+            self.sync_repo(repo)
+            return True
+
+        if not boxhatter.webhook.verify(headers, body, secret):
+            return False
+
+        push = boxhatter.webhook.parse_push(headers, body)
+        if not push:
+            self.sync_repo(repo)
+            return True
+
+        patterns = repo_conf.get('refs', ['refs/heads/*'])
+        if not _match_ref(push.ref, patterns):
+            return True
+
+        async with self._refs_locks[repo]:
+            refs = dict(self._refs.get(repo, {}))
+            if push.hash:
+                refs[push.ref] = push.hash
+            else:
+                refs.pop(push.ref, None)
+
+            await self._update_refs(repo, refs, common.Priority.WEBHOOK)
+
+        return True
+
+    def verify_worker_token(self, token: str) -> bool:
+        worker_token = self._conf.get('worker_token')
+        if worker_token is None:
+            return False
+
+        return hmac.compare_digest(token.encode('utf-8'),
+                                   worker_token.encode('utf-8'))
+
+    async def lease_commit(self, worker: str) -> common.Job:
+        commit = await self._scheduler.get(leased=True)
+
+        repo_conf = self._conf['repos'][commit.repo]
+        lease_timeout = self._conf.get('worker_lease_timeout', 60)
+        lease = _Lease(lease_id=uuid.uuid4().hex,
+                       worker=worker,
+                       timeout=lease_timeout)
+        self._leases[lease.lease_id] = lease
+        self.async_group.spawn(self._run, commit, lease)
+
+        return common.Job(lease=lease.lease_id,
+                          repo=commit.repo,
+                          hash=commit.hash,
+                          url=repo_conf['url'],
+                          action=repo_conf.get('action', '.boxhatter.yaml'),
+                          env={**self._conf.get('env', {}),
+                               **repo_conf.get('env', {})},
+                          cache_dst=repo_conf.get('cache',
+                                                  '.boxhatter_cache'),
+                          timeout=repo_conf.get('timeout'),
+                          lease_timeout=lease_timeout)
+
+    def heartbeat_lease(self, lease_id: str) -> bool:
+        lease = self._leases.get(lease_id)
+        if not lease:
+            return False
+
+        lease.heartbeat()
+        return True
+
+    async def write_lease_output(self, lease_id: str, data: bytes) -> bool:
+        lease = self._leases.get(lease_id)
+        if not lease:
+            return False
+
+        await lease.write(data)
+        return True
+
+    def finish_lease(self,
+                     lease_id: str,
+                     error: typing.Optional[str]
+                     ) -> bool:
+        lease = self._leases.get(lease_id)
+        if not lease:
+            return False
+
+        lease.finish(error)
+        return True
 
     async def remove_commit(self, commit: common.Commit):
+        self._scheduler.remove(commit.repo, commit.hash)
         await self._backend.remove_commit(commit)
 
-    async def _sync_loop(self, repo, repo_conf, sync_event):
+    async def _run_commits(self, repo, commit_hashes, priority):
+        change = int(time.time())
+        commits = [common.Commit(repo=repo,
+                                 hash=commit_hash,
+                                 change=change,
+                                 status=common.Status.PENDING,
+                                 output='')
+                   for commit_hash in commit_hashes]
+        await self._backend.update_commits(commits)
+
+        for commit in commits:
+            self._scheduler.put(commit, priority)
+
+        return commits
+
+    async def _sync_loop(self):
+        try:
+            while True:
+                repo = await self._sync_scheduler.get()
+                self.async_group.spawn(self._sync, repo)
+
+        finally:
+            self.close()
+
+    async def _sync(self, repo):
+        success = False
+
         try:
+            repo_conf = self._conf['repos'][repo]
             url = repo_conf['url']
             refs = repo_conf.get('refs', ['refs/heads/*'])
-            min_sync_delay = repo_conf.get('min_sync_delay', 60) or 0
-            max_sync_delay = repo_conf.get('max_sync_delay')
-            last_sync = time.monotonic() - min_sync_delay
+            refs_version = self._refs_versions[repo]
+
+            priority = (common.Priority.WEBHOOK
+                        if repo in self._webhook_syncs
+                        else common.Priority.SYNC)
+            self._webhook_syncs.discard(repo)
+
+            start = time.monotonic()
+            try:
+                remote_refs = await _git_ls_remote(url, refs)
+                error = None
+
+            except Exception as e:
+                error = str(e).strip() or 'synchronization failed'
+
+            self._sync_states[repo] = common.SyncState(
+                last_sync=time.time(),
+                duration=time.monotonic() - start,
+                error=error)
+            if error:
+                return
+
+            success = True
+
+            async with self._refs_locks[repo]:
+                if self._refs_versions[repo] != refs_version:
+                    self._sync_scheduler.request(repo)
+                    return
+
+                await self._update_refs(repo, remote_refs, priority)
+
+        except Exception:
+            self.close()
+            raise
+
+        finally:
+            self._sync_scheduler.release(repo, success)
 
+    async def _update_refs(self, repo, refs, priority):
+        supersede = self._conf['repos'][repo].get('supersede', False)
+        previous_refs = self._refs.get(repo, {})
+        changed_refs = {ref: commit_hash
+                        for ref, commit_hash in refs.items()
+                        if previous_refs.get(ref) != commit_hash}
+        removed_refs = [ref for ref in previous_refs if ref not in refs]
+        if not changed_refs and not removed_refs:
+            return
+
+        self._refs[repo] = refs
+        self._refs_versions[repo] += 1
+
+        if supersede:
+            superseded = {previous_refs[ref]: commit_hash
+                          for ref, commit_hash in changed_refs.items()
+                          if ref in previous_refs}
+            for commit_hash in refs.values():
+                superseded.pop(commit_hash, None)
+            if superseded:
+                await self._supersede_commits(repo, superseded)
+
+        commit_hashes = await self._backend.get_unknown_hashes(
+            repo, changed_refs.values())
+
+        # new commits are not executed until their action weight is read
+        self._scheduler.hold(repo, commit_hashes)
+        self.async_group.spawn(self._update_mirror, repo, commit_hashes)
+
+        if commit_hashes:
+            await self._run_commits(repo, commit_hashes, priority)
+
+        await self._backend.update_refs(repo, changed_refs, removed_refs)
+
+    async def _update_mirror(self, repo, commit_hashes):
+        mirror = self._mirrors[repo]
+        action = self._conf['repos'][repo].get('action', '.boxhatter.yaml')
+        images = set()
+
+        try:
+            with contextlib.suppress(Exception):
+                await mirror.update(self._refs.get(repo, {}))
+
+            for commit_hash in commit_hashes:
+                weight = None
+
+                with contextlib.suppress(Exception):
+                    data = await mirror.read_file(commit_hash, action)
+                    conf = json.decode(data, json.Format.YAML)
+                    common.json_schema_repo.validate(
+                        'boxhatter://action.yaml#', conf)
+                    images.update(_get_action_images(conf))
+                    weight = conf.get('weight')
+
+                self._scheduler.resolve(repo, commit_hash, weight)
+
+        finally:
+            for commit_hash in commit_hashes:
+                self._scheduler.resolve(repo, commit_hash, None)
+
+        for image in images:
+            self._image_manager.prepare(image)
+
+    async def _run_loop(self):
+        try:
             while True:
-                dt = time.monotonic() - last_sync
-                if dt < min_sync_delay:
-                    await asyncio.sleep(min_sync_delay - dt)
+                commit = await self._scheduler.get()
+                self.async_group.spawn(self._run, commit)
+
+        finally:
+            self.close()
+
+    async def _supersede_commits(self, repo, superseded):
+        commits = collections.deque()
+
+        for commit_hash, new_commit_hash in superseded.items():
+            commit = self._scheduler.remove(repo, commit_hash)
+
+            task = self._runs.get((repo, commit_hash))
+            if task:
+                task.cancel()
+                await asyncio.wait([task])
+                commit = await self._backend.get_commit(repo, commit_hash,
+                                                        with_output=False)
+
+            if not commit:
+                continue
+
+            note = f'superseded by {new_commit_hash}\n'
+            await self._backend.append_output(repo, commit_hash,
+                                              note.encode('utf-8'))
+            commits.append(commit._replace(change=int(time.time()),
+                                           status=common.Status.SUPERSEDED,
+                                           output=None))
+
+        if commits:
+            await self._backend.update_commits(commits)
 
-                sync_event.clear()
-                commit_hashes = await _git_ls_remote(url, refs)
-                last_sync = time.monotonic()
+    async def _run(self, commit, lease=None, container=None):
+        key = commit.repo, commit.hash
+        self._runs[key] = asyncio.current_task()
 
-                for commit_hash in commit_hashes:
-                    commit = await self._backend.get_commit(repo, commit_hash)
-                    if commit:
-                        continue
-                    await self.run_commit(repo, commit_hash)
+        try:
+            repo_conf = self._conf['repos'][commit.repo]
+            action = repo_conf.get('action', '.boxhatter.yaml')
+            env = {**self._conf.get('env', {}),
+                   **repo_conf.get('env', {})}
+            cache_dst = repo_conf.get('cache', '.boxhatter_cache')
+            url = repo_conf['url']
+            ref = commit.hash
+            container_name = f'boxhatter-{uuid.uuid4()}'
+            mirror = self._mirrors[commit.repo]
+            image_manager = self._image_manager
+            timeout = repo_conf.get('timeout')
+
+            commit = commit._replace(change=int(time.time()),
+                                     status=common.Status.RUNNING,
+                                     output='')
+            await self._backend.update_commit(commit)
+
+            max_output_size = repo_conf.get(
+                'max_output_size', self._conf.get('max_output_size', 10))
+            output = _Output(backend=self._backend,
+                             repo=commit.repo,
+                             commit_hash=commit.hash,
+                             max_size=max_output_size * 1024 * 1024)
+
+            cache_src = None
 
-                if max_sync_delay is None:
-                    await sync_event.wait()
+            try:
+                if lease:
+                    lease.start(output)
+                    await output.write(f'running on worker {lease.worker}\n'
+                                       .encode('utf-8'))
+                    await lease.wait()
+
+                elif container:
+                    if container.cache and container.cache.exists():
+                        cache_src = container.cache
+
+                    await output.write(f'reattached to container '
+                                       f'{container.name}\n'.encode('utf-8'))
+                    await boxhatter.executor.attach(container=container,
+                                                    output=output,
+                                                    timeout=timeout)
 
                 else:
-                    with contextlib.suppress(asyncio.TimeoutError):
-                        await asyncio.wait_for(sync_event.wait(),
-                                               max_sync_delay)
+                    cache_src = await self._cache_manager.create_snapshot(
+                        commit.repo)
+                    await boxhatter.executor.execute(
+                        action=action,
+                        env=env,
+                        cache_src=cache_src,
+                        cache_dst=cache_dst,
+                        url=url,
+                        ref=ref,
+                        container_name=container_name,
+                        output=output,
+                        mirror=mirror,
+                        image_manager=image_manager,
+                        timeout=timeout,
+                        labels=self._get_labels(commit))
 
-        finally:
+                if cache_src:
+                    await self._cache_manager.promote(commit.repo, cache_src)
+                    cache_src = None
+
+                status = common.Status.SUCCESS
+
+            except asyncio.CancelledError:
+                await aio.uncancellable(output.flush())
+
+                if self.is_closing:
+                    cache_src = None
+
+                else:
+                    await aio.uncancellable(self._remove_containers(commit))
+
+                raise
+
+            except _LeaseExpiredError:
+                await output.write(f'lease on worker {lease.worker} '
+                                   f'expired\n'.encode('utf-8'))
+                status = common.Status.PENDING
+
+            except Exception as e:
+                await output.write(f'{e}\n'.encode('utf-8'))
+                status = common.Status.FAILURE
+
+            finally:
+                if cache_src:
+                    await aio.uncancellable(
+                        self._cache_manager.remove(commit.repo, cache_src))
+
+            await output.flush()
+
+            commit = commit._replace(change=int(time.time()),
+                                     status=status,
+                                     output=None)
+            await self._backend.update_commit(commit)
+
+            if status == common.Status.PENDING:
+                self._scheduler.put(commit, common.Priority.RECOVERY)
+
+        except Exception:
             self.close()
+            raise
 
-    async def _run_loop(self):
+        finally:
+            self._scheduler.release(commit, leased=lease is not None)
+            if self._runs.get(key) is asyncio.current_task():
+                del self._runs[key]
+            if lease:
+                del self._leases[lease.lease_id]
+
+    async def _remove_containers(self, commit):
+        with contextlib.suppress(Exception):
+            containers = await boxhatter.executor.get_containers(
+                self._get_labels(commit))
+
+            for container in containers:
+                await boxhatter.executor.remove(container)
+
+    def _get_labels(self, commit):
+        return {server_label: str(self.server_uuid),
+                repo_label: commit.repo,
+                commit_label: commit.hash}
+
+    async def _prune_loop(self):
         try:
+            prune_delay = self._conf.get('prune_delay', 3600)
+
             while True:
-                commit = await self._run_queue.get()
-                repo_conf = self._conf['repos'][commit.repo]
-                action = repo_conf.get('action', '.boxhatter.yaml')
-                env = {**self._conf.get('env', {}),
-                       **repo_conf.get('env', {})}
-                cache_src = self._cache_path / commit.repo
-                cache_dst = repo_conf.get('cache', '.boxhatter_cache')
-                url = repo_conf['url']
-                ref = commit.hash
-
-                commit = commit._replace(change=int(time.time()),
-                                         status=common.Status.RUNNING,
-                                         output='')
-                await self._backend.update_commit(commit)
-
-                try:
-                    cache_src.mkdir(parents=True, exist_ok=True)
-                    output = await _execute(action=action,
-                                            env=env,
-                                            cache_src=cache_src,
-                                            cache_dst=cache_dst,
-                                            url=url,
-                                            ref=ref)
-                    status = common.Status.SUCCESS
-
-                except Exception as e:
-                    output = str(e)
-                    status = common.Status.FAILURE
-
-                commit = commit._replace(change=int(time.time()),
-                                         status=status,
-                                         output=output)
-                await self._backend.update_commit(commit)
+                for repo, repo_conf in self._conf['repos'].items():
+                    retention = {**self._conf.get('retention', {}),
+                                 **repo_conf.get('retention', {})}
+                    await self._prune_repo(repo, retention)
+
+                await asyncio.sleep(prune_delay)
 
         finally:
             self.close()
 
+    async def _prune_repo(self, repo, retention):
+        max_commits = retention.get('max_commits')
+        max_age = retention.get('max_age')
+        if max_commits is None and max_age is None:
+            return
 
-async def _execute(action, env, cache_src, cache_dst, url, ref):
-    cmd = [sys.executable, '-m', 'boxhatter',
-           '--log-level', common.settings.log_level,
-           *(['--ssh-key', common.settings.ssh_key]
-             if common.settings.ssh_key else []),
-           '--engine', common.settings.engine,
-           'execute',
-           '--action', action,
-           *itertools.chain.from_iterable(('--env', i) for i in env),
-           '--cache-src', str(cache_src),
-           '--cache-dst', cache_dst,
-           url, ref]
+        min_change = (int(time.time() - max_age * 24 * 60 * 60)
+                      if max_age is not None else None)
 
-    p = await asyncio.create_subprocess_exec(*cmd,
-                                             stdin=subprocess.DEVNULL,
-                                             stdout=subprocess.PIPE,
-                                             stderr=subprocess.STDOUT,
-                                             env={**os.environ, **env})
+        while True:
+            commits = await self._backend.prune_commits(
+                repo=repo,
+                max_commits=max_commits,
+                min_change=min_change,
+                limit=prune_batch_size)
+            if len(commits) < prune_batch_size:
+                break
 
-    try:
-        output, _ = await p.communicate()
-        output = str(output, encoding='utf-8', errors='ignore')
+            await asyncio.sleep(prune_batch_delay)
 
-        if p.returncode:
-            raise Exception(output)
 
-        return output
+class _Scheduler:
 
-    finally:
-        if p.returncode is None:
-            p.terminate()
+    def __init__(self, max_parallel, repo_max_parallel, repo_weights):
+        self._max_parallel = max_parallel
+        self._repo_max_parallel = repo_max_parallel
+        self._repo_weights = repo_weights
+        self._queues = {priority: collections.OrderedDict()
+                        for priority in common.Priority}
+        self._items = {}
+        self._event = asyncio.Event()
+        self._used_slots = 0
+        self._repo_running = collections.Counter()
+        self._weights = {}
+        self._acquired_weights = collections.defaultdict(list)
+        self._held = set()
+
+    def get_items(self):
+        items = []
+
+        for priority, queue in self._queues.items():
+            repo_keys = [list(keys) for keys in queue.values()]
+            for keys in itertools.zip_longest(*repo_keys):
+                items.extend(common.QueueItem(repo=key[0],
+                                              hash=key[1],
+                                              priority=priority)
+                             for key in keys if key)
+
+        return items
+
+    def put(self, commit, priority):
+        key = commit.repo, commit.hash
+        item = self._items.get(key)
+
+        if item and item[0].value <= priority.value:
+            self._items[key] = item[0], commit
+            return
+
+        if item:
+            self._remove_item(key)
+
+        self._items[key] = priority, commit
+        queue = self._queues[priority]
+        if commit.repo not in queue:
+            queue[commit.repo] = collections.deque()
+        queue[commit.repo].append(key)
+        self._event.set()
+
+    def remove(self, repo, commit_hash):
+        key = repo, commit_hash
+        commit = self._remove_item(key)
+        if key not in self._acquired_weights:
+            self._weights.pop(key, None)
+        self._held.discard(key)
+
+        return commit
+
+    def hold(self, repo, commit_hashes):
+        self._held.update((repo, commit_hash)
+                          for commit_hash in commit_hashes)
+
+    def resolve(self, repo, commit_hash, weight):
+        key = repo, commit_hash
+        if weight is not None:
+            self._weights[key] = weight
+
+        if key in self._held:
+            self._held.remove(key)
+            self._event.set()
+
+    async def get(self, leased=False):
+        while True:
+            commit = self._get_admissible(leased)
+            if commit:
+                self.acquire(commit, leased)
+                return commit
+
+            self._event.clear()
+            await self._event.wait()
+
+    def acquire(self, commit, leased=False):
+        key = commit.repo, commit.hash
+        weight = self._get_weight(key) if not leased else 0
+        self._acquired_weights[key].append(weight)
+        self._used_slots += weight
+        self._repo_running[commit.repo] += 1
+
+    def release(self, commit, leased=False):
+        key = commit.repo, commit.hash
+        weights = self._acquired_weights.pop(key, [])
+        if weights:
+            self._used_slots -= weights.pop()
+        if weights:
+            self._acquired_weights[key] = weights
+        elif key not in self._items:
+            self._weights.pop(key, None)
+        self._repo_running[commit.repo] -= 1
+        self._event.set()
+
+    def _get_admissible(self, leased):
+        for queue in self._queues.values():
+            for repo, keys in queue.items():
+                max_parallel = self._repo_max_parallel.get(repo)
+                if (max_parallel is not None and
+                        self._repo_running[repo] >= max_parallel):
+                    continue
+
+                if keys[0] in self._held:
+                    continue
+
+                if (not leased and
+                        self._used_slots + self._get_weight(keys[0]) >
+                        self._max_parallel):
+                    return
+
+                key = keys.popleft()
+                if keys:
+                    queue.move_to_end(repo)
+                else:
+                    del queue[repo]
+
+                _, commit = self._items.pop(key)
+                return commit
+
+    def _remove_item(self, key):
+        item = self._items.pop(key, None)
+        if not item:
+            return
+
+        priority, commit = item
+        queue = self._queues[priority]
+        queue[key[0]].remove(key)
+        if not queue[key[0]]:
+            del queue[key[0]]
+
+        return commit
+
+    def _get_weight(self, key):
+        weight = self._weights.get(key)
+        if weight is None:
+            weight = self._repo_weights.get(key[0], 1)
+
+        return min(weight, self._max_parallel)
+
+
+class _SyncScheduler:
+
+    def __init__(self, repo_sync_delays, max_parallel, jitter, retry_delay,
+                 max_retry_delay):
+        now = time.monotonic()
+        self._repo_sync_delays = repo_sync_delays
+        self._max_parallel = max_parallel
+        self._jitter = jitter
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._last_syncs = {repo: now - min_delay
+                            for repo, (min_delay, _) in
+                            repo_sync_delays.items()}
+        self._deadlines = {repo: now for repo in repo_sync_delays}
+        self._requests = set()
+        self._failures = collections.Counter()
+        self._running = set()
+        self._event = asyncio.Event()
+
+    def request(self, repo):
+        self._requests.add(repo)
+        self._event.set()
+
+    async def get(self):
+        while True:
+            self._event.clear()
+            now = time.monotonic()
+            timeout = None
+
+            if len(self._running) < self._max_parallel:
+                due_times = {repo: self._get_due_time(repo)
+                             for repo in self._repo_sync_delays
+                             if repo not in self._running}
+                due_times = {repo: due_time
+                             for repo, due_time in due_times.items()
+                             if due_time is not None}
+
+                if due_times:
+                    repo = min(due_times, key=due_times.get)
+                    if due_times[repo] <= now:
+                        self._running.add(repo)
+                        self._requests.discard(repo)
+                        self._last_syncs[repo] = now
+                        self._deadlines[repo] = None
+                        return repo
+
+                    timeout = due_times[repo] - now
+
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._event.wait(), timeout)
+
+    def release(self, repo, success):
+        self._running.discard(repo)
+
+        if success:
+            self._failures.pop(repo, None)
+            max_delay = self._repo_sync_delays[repo][1]
+            self._deadlines[repo] = (
+                time.monotonic() + self._apply_jitter(max_delay)
+                if max_delay is not None else None)
+
+        else:
+            self._failures[repo] += 1
+            self._deadlines[repo] = (self._last_syncs[repo] +
+                                     self._get_retry_delay(repo))
+
+        self._event.set()
+
+    def _get_due_time(self, repo):
+        min_delay = self._repo_sync_delays[repo][0]
+        earliest = self._last_syncs[repo] + min_delay
+        if self._failures[repo]:
+            earliest = max(earliest, self._deadlines[repo])
+
+        due_times = ([self._deadlines[repo]]
+                     if self._deadlines[repo] is not None else [])
+        if repo in self._requests:
+            due_times.append(earliest)
+
+        if not due_times:
+            return
+
+        return max(earliest, min(due_times))
+
+    def _get_retry_delay(self, repo):
+        retry_delay = min(self._retry_delay * 2 ** (self._failures[repo] - 1),
+                          self._max_retry_delay)
+        return self._apply_jitter(retry_delay)
+
+    def _apply_jitter(self, delay):
+        return delay * (1 + random.uniform(-self._jitter, self._jitter))
+
+
+class _LeaseExpiredError(Exception):
+    pass
+
+
+class _Lease:
+
+    def __init__(self, lease_id, worker, timeout):
+        self._lease_id = lease_id
+        self._worker = worker
+        self._timeout = timeout
+        self._last_heartbeat = time.monotonic()
+        self._output = None
+        self._started = asyncio.Event()
+        self._result = asyncio.get_running_loop().create_future()
+
+    @property
+    def lease_id(self):
+        return self._lease_id
+
+    @property
+    def worker(self):
+        return self._worker
+
+    def start(self, output):
+        self._output = output
+        self._started.set()
+
+    def heartbeat(self):
+        self._last_heartbeat = time.monotonic()
+
+    async def write(self, data):
+        self.heartbeat()
+        await self._started.wait()
+        await self._output.write(data)
+
+    def finish(self, error):
+        self.heartbeat()
+        if not self._result.done():
+            self._result.set_result(error)
+
+    async def wait(self):
+        while not self._result.done():
+            timeout = self._last_heartbeat + self._timeout - time.monotonic()
+            if timeout <= 0:
+                raise _LeaseExpiredError()
+
+            await asyncio.wait([self._result], timeout=timeout)
+
+        error = self._result.result()
+        if error is not None:
+            raise Exception(error)
+
+
+class _Output(boxhatter.executor.Output):
+
+    def __init__(self, backend, repo, commit_hash, max_size):
+        chunk_size = boxhatter.backend.output_chunk_size
+        self._backend = backend
+        self._repo = repo
+        self._commit_hash = commit_hash
+        self._data = bytearray()
+        self._last_flush = time.monotonic()
+        self._tail_size = max_size // 2
+        self._head_size = ((max_size - self._tail_size) // chunk_size *
+                           chunk_size)
+        self._size = 0
+        self._marker_chunk = None
+        self._truncated = 0
+
+    async def write(self, data):
+        if (self._marker_chunk is None and
+                self._size + len(data) > self._head_size):
+            head_data = data[:self._head_size - self._size]
+            data = data[len(head_data):]
+
+            self._data.extend(head_data)
+            self._size += len(head_data)
+            await self.flush()
+
+            # head is stored as full chunks followed by marker chunk
+            self._marker_chunk = (self._head_size //
+                                  boxhatter.backend.output_chunk_size)
+            await self._backend.set_output_chunk(self._repo,
+                                                 self._commit_hash,
+                                                 self._marker_chunk, b'')
+
+        self._data.extend(data)
+        self._size += len(data)
+
+        if (len(self._data) >= boxhatter.backend.output_chunk_size or
+                time.monotonic() - self._last_flush >= output_flush_delay):
+            await self.flush()
+
+    async def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._data:
+            return
+
+        data, self._data = bytes(self._data), bytearray()
+
+        if self._marker_chunk is None:
+            await self._backend.append_output(self._repo, self._commit_hash,
+                                              data)
+            return
+
+        await self._backend.append_output(self._repo, self._commit_hash,
+                                          data, self._marker_chunk + 1)
+
+        truncated = await self._backend.prune_output(self._repo,
+                                                     self._commit_hash,
+                                                     self._marker_chunk + 1,
+                                                     self._tail_size)
+        if not truncated:
+            return
+
+        self._truncated += truncated
+        await self._backend.set_output_chunk(
+            self._repo, self._commit_hash, self._marker_chunk,
+            f'\n[... {self._truncated} bytes of output truncated ...]\n'
+            .encode('utf-8'))
+
+
+def _get_cache_size(size):
+    return size * 1024 * 1024 if size is not None else None
+
+
+def _get_action_images(conf):
+    if 'jobs' in conf:
+        return [job['image'] for job in conf['jobs'].values()]
+
+    return [conf['image']]
+
+
+def _match_ref(ref, patterns):
+    return any(fnmatch.fnmatchcase(f'/{ref}', f'*/{pattern}')
+               for pattern in patterns)
 
 
 async def _git_ls_remote(url, refs):
@@ -239,20 +1056,17 @@ async def _git_ls_remote(url, refs):
             stderr = str(stderr, encoding='utf-8', errors='ignore')
             raise Exception(stderr)
 
-        result = collections.deque()
+        result = {}
         stdout = str(stdout, encoding='utf-8', errors='ignore')
 
         for line in stdout.split('\n'):
             segments = line.split(maxsplit=1)
-            if not segments:
+            if len(segments) < 2:
                 continue
-            result.append(segments[0])
+            result[segments[1]] = segments[0]
 
         return result
 
-    except Exception:
-        return []
-
     finally:
         if p.returncode is None:
             p.terminate()
@@ -1,7 +1,10 @@
 from pathlib import Path
+import asyncio
 import contextlib
 import datetime
+import html
 import time
+import urllib.parse
 import uuid
 
 from hat import aio
@@ -15,15 +18,43 @@ static_dir: Path = common.package_path / 'ui'
 
 pagination_limit: int = 20
 
+worker_poll_timeout: float = 30
+
+webhook_max_size: int = 25 * 1024 * 1024
+
+_html_tail = ('</body>\n'
+              '</html>\n')
+
 
 async def create(host: str,
                  port: int,
                  server: boxhatter.server.Server
                  ) -> 'UI':
     ui = UI()
-    ui._server = server
     ui._async_group = aio.Group()
 
+    runner = aiohttp.web.AppRunner(create_app(server))
+    await runner.setup()
+    ui.async_group.spawn(aio.call_on_cancel, runner.cleanup)
+
+    try:
+        site = aiohttp.web.TCPSite(runner=runner,
+                                   host=host,
+                                   port=port,
+                                   shutdown_timeout=0.1,
+                                   reuse_address=True)
+        await site.start()
+
+    except BaseException:
+        await aio.uncancellable(ui.async_group.async_close())
+        raise
+
+    return ui
+
+
+def create_app(server: boxhatter.server.Server) -> aiohttp.web.Application:
+    ui = _Handler(server)
+
     app = aiohttp.web.Application()
     get_routes = (
         aiohttp.web.get(path, handler) for path, handler in (
@@ -31,34 +62,25 @@ async def create(host: str,
             ('/feed', ui._process_get_feed),
             ('/repo/{repo}', ui._process_get_repo),
             ('/repo/{repo}/commit/{commit}', ui._process_get_commit),
+            ('/repo/{repo}/commit/{commit}/output', ui._process_get_output),
             ('/repo/{repo}/feed', ui._process_get_feed)))
     post_routes = (
         aiohttp.web.post(path, handler) for path, handler in (
             ('/repo/{repo}/run', ui._process_post_run),
             ('/repo/{repo}/clear', ui._process_post_clear),
-            ('/repo/{repo}/commit/{commit}/remove', ui._process_post_remove)))
+            ('/repo/{repo}/commit/{commit}/remove', ui._process_post_remove),
+            ('/worker/lease', ui._process_post_worker_lease),
+            ('/worker/lease/{lease}/heartbeat',
+             ui._process_post_worker_heartbeat),
+            ('/worker/lease/{lease}/output', ui._process_post_worker_output),
+            ('/worker/lease/{lease}/finish',
+             ui._process_post_worker_finish)))
     webhook_route = aiohttp.web.route('*', '/repo/{repo}/webhook',
                                       ui._process_webhook)
     static_route = aiohttp.web.static('/', static_dir)
     app.add_routes([*get_routes, *post_routes, webhook_route, static_route])
 
-    runner = aiohttp.web.AppRunner(app)
-    await runner.setup()
-    ui.async_group.spawn(aio.call_on_cancel, runner.cleanup)
-
-    try:
-        site = aiohttp.web.TCPSite(runner=runner,
-                                   host=host,
-                                   port=port,
-                                   shutdown_timeout=0.1,
-                                   reuse_address=True)
-        await site.start()
-
-    except BaseException:
-        await aio.uncancellable(ui.async_group.async_close())
-        raise
-
-    return ui
+    return app
 
 
 class UI(aio.Resource):
@@ -67,35 +89,40 @@ class UI(aio.Resource):
     def async_group(self) -> aio.Group:
         return self._async_group
 
+
+class _Handler:
+
+    def __init__(self, server):
+        self._server = server
+
     async def _process_get_root(self, request):
-        page = self._get_page(request)
-        offset = page * pagination_limit
-        commits = await self._server.get_commits(repo=None,
-                                                 limit=pagination_limit + 1,
-                                                 offset=offset)
-        commits, more_follows = (commits[:pagination_limit],
-                                 len(commits) > pagination_limit)
-
-        body = (f'{_generate_repos(self._server.repos)}\n'
+        commits, previous_cursor, next_cursor = await self._get_page(request,
+                                                                     None)
+
+        status_counts = await self._server.get_status_counts()
+        sync_states = self._server.get_sync_states()
+
+        queue = self._server.get_queue()
+
+        repos = _generate_repos(self._server.repos, status_counts, sync_states)
+        body = (f'{repos}\n'
+                f'{_generate_queue(queue)}\n'
                 f'{_generate_commits(commits)}\n'
-                f'{_generate_pagination(page, more_follows)}')
+                f'{_generate_pagination(previous_cursor, next_cursor)}')
         return _create_html_response('Box Hatter', body, '/feed')
 
     async def _process_get_repo(self, request):
         repo = self._get_repo(request)
-        page = self._get_page(request)
-        offset = page * pagination_limit
-        commits = await self._server.get_commits(repo=repo,
-                                                 limit=pagination_limit + 1,
-                                                 offset=offset)
-        commits, more_follows = (commits[:pagination_limit],
-                                 len(commits) > pagination_limit)
+        commits, previous_cursor, next_cursor = await self._get_page(request,
+                                                                     repo)
+
+        cache_usage = self._server.get_cache_usage(repo)
 
         title = f'Box Hatter - {repo}'
         body = (f'{_generate_commits(commits)}\n'
-                f'{_generate_pagination(page, more_follows)}\n'
+                f'{_generate_pagination(previous_cursor, next_cursor)}\n'
                 f'{_generate_run(repo)}\n'
-                f'{_generate_clear(repo)}')
+                f'{_generate_clear(repo, cache_usage)}')
         feed_url = f'/repo/{repo}/feed'
         return _create_html_response(title, body, feed_url)
 
@@ -103,14 +130,36 @@ class UI(aio.Resource):
         commit = await self._get_commit(request)
 
         title = f'Box Hatter - {commit.repo}/{commit.hash}'
-        body = _generate_commit(commit)
         feed_url = f'/repo/{commit.repo}/feed'
-        return _create_html_response(title, body, feed_url)
+        body_head, body_tail = _generate_commit(commit)
+        output = self._server.get_output(commit.repo, commit.hash)
+
+        response = await _prepare_stream_response(request, 'text/html')
+        await response.write(
+            f'{_generate_html_head(title, feed_url)}{body_head}'.encode())
+        async for text in output:
+            await response.write(html.escape(text).encode())
+        await response.write(f'{body_tail}\n{_html_tail}'.encode())
+        await response.write_eof()
+        return response
+
+    async def _process_get_output(self, request):
+        commit = await self._get_commit(request)
+        output = self._server.get_output(commit.repo, commit.hash, True)
+
+        response = await _prepare_stream_response(request, 'text/plain')
+        async for text in output:
+            await response.write(text.encode())
+        await response.write_eof()
+        return response
 
     async def _process_get_feed(self, request):
         repo = (self._get_repo(request) if 'repo' in request.match_info
                 else None)
-        commits = await self._server.get_commits(repo, None, None)
+        commits = await self._server.get_commits(repo=repo,
+                                                 order=common.Order.DESC,
+                                                 limit=None,
+                                                 cursor=None)
 
         title = 'All repositories' if repo is None else f'Repository {repo}'
         text = _generate_feed(self._server.server_uuid, title, commits)
@@ -147,34 +196,163 @@ class UI(aio.Resource):
     async def _process_webhook(self, request):
         repo = self._get_repo(request)
 
-        self._server.sync_repo(repo)
+        body = await _read_body(request, webhook_max_size)
+
+        if not await self._server.process_webhook(repo, request.headers,
+                                                  body):
+            raise aiohttp.web.HTTPForbidden()
+
+        return aiohttp.web.Response()
+
+    async def _process_post_worker_lease(self, request):
+        self._verify_worker(request)
+
+        body = await _read_json(request)
+        worker = body.get('worker')
+        if not isinstance(worker, str):
+            raise aiohttp.web.HTTPBadRequest()
+
+        try:
+            job = await asyncio.wait_for(self._server.lease_commit(worker),
+                                         worker_poll_timeout)
+
+        except asyncio.TimeoutError:
+            return aiohttp.web.Response(status=204)
+
+        return aiohttp.web.json_response(job._asdict())
+
+    async def _process_post_worker_heartbeat(self, request):
+        self._verify_worker(request)
+
+        lease_id = request.match_info['lease']
+        if not self._server.heartbeat_lease(lease_id):
+            raise aiohttp.web.HTTPNotFound()
+
+        return aiohttp.web.Response()
+
+    async def _process_post_worker_output(self, request):
+        self._verify_worker(request)
+
+        lease_id = request.match_info['lease']
+        data = await request.read()
+        if not await self._server.write_lease_output(lease_id, data):
+            raise aiohttp.web.HTTPNotFound()
+
         return aiohttp.web.Response()
 
+    async def _process_post_worker_finish(self, request):
+        self._verify_worker(request)
+
+        lease_id = request.match_info['lease']
+        body = await _read_json(request)
+        error = body.get('error')
+        if error is not None and not isinstance(error, str):
+            raise aiohttp.web.HTTPBadRequest()
+
+        if not self._server.finish_lease(lease_id, error):
+            raise aiohttp.web.HTTPNotFound()
+
+        return aiohttp.web.Response()
+
+    def _verify_worker(self, request):
+        authorization = request.headers.get('Authorization', '')
+        scheme, _, token = authorization.partition(' ')
+        if (scheme != 'Bearer' or
+                not self._server.verify_worker_token(token.strip())):
+            raise aiohttp.web.HTTPForbidden()
+
     def _get_repo(self, request):
         repo = request.match_info['repo']
         if repo not in self._server.repos:
             raise aiohttp.web.HTTPBadRequest()
         return repo
 
-    def _get_page(self, request):
-        page_str = request.query.get('page', '0')
-        with contextlib.suppress(ValueError):
-            page = int(page_str)
-            if page >= 0:
-                return page
-        raise aiohttp.web.HTTPBadRequest()
+    async def _get_page(self, request, repo):
+        if 'before' in request.query:
+            cursor = _decode_cursor(request.query['before'])
+            commits = await self._server.get_commits(
+                repo=repo,
+                order=common.Order.ASC,
+                limit=pagination_limit + 1,
+                cursor=cursor)
+            more_follows = len(commits) > pagination_limit
+            commits = list(reversed(commits[:pagination_limit]))
+
+            previous_cursor = (_get_cursor(commits[0])
+                               if commits and more_follows else None)
+            next_cursor = _get_cursor(commits[-1]) if commits else cursor
+
+        else:
+            cursor = (_decode_cursor(request.query['after'])
+                      if 'after' in request.query else None)
+            commits = await self._server.get_commits(
+                repo=repo,
+                order=common.Order.DESC,
+                limit=pagination_limit + 1,
+                cursor=cursor)
+            more_follows = len(commits) > pagination_limit
+            commits = commits[:pagination_limit]
+
+            previous_cursor = (_get_cursor(commits[0])
+                               if commits and cursor else cursor)
+            next_cursor = (_get_cursor(commits[-1])
+                           if commits and more_follows else None)
+
+        return commits, previous_cursor, next_cursor
 
     async def _get_commit(self, request):
         repo = self._get_repo(request)
         commit_hash = request.match_info['commit']
-        commit = await self._server.get_commit(repo, commit_hash)
+        commit = await self._server.get_commit(repo, commit_hash, False)
         if not commit:
             raise aiohttp.web.HTTPBadRequest()
         return commit
 
 
+async def _read_body(request, max_size):
+    body = bytearray()
+
+    async for data in request.content.iter_any():
+        body.extend(data)
+        if len(body) > max_size:
+            raise aiohttp.web.HTTPRequestEntityTooLarge(
+                max_size=max_size,
+                actual_size=len(body))
+
+    return bytes(body)
+
+
+async def _read_json(request):
+    try:
+        body = await request.json()
+
+    except Exception:
+        raise aiohttp.web.HTTPBadRequest()
+
+    if not isinstance(body, dict):
+        raise aiohttp.web.HTTPBadRequest()
+
+    return body
+
+
 def _create_html_response(title, body, feed_url):
-    text = (f'<!DOCTYPE html>\n'
+    text = (f'{_generate_html_head(title, feed_url)}'
+            f'{body}\n'
+            f'{_html_tail}')
+    return aiohttp.web.Response(content_type='text/html',
+                                text=text)
+
+
+async def _prepare_stream_response(request, content_type):
+    response = aiohttp.web.StreamResponse()
+    response.content_type = content_type
+    response.charset = 'utf-8'
+    await response.prepare(request)
+    return response
+
+
+def _generate_html_head(title, feed_url):
+    return (f'<!DOCTYPE html>\n'
             f'<html>\n'
             f'<head>\n'
             f'<meta charset="UTF-8">\n'
@@ -183,17 +361,17 @@ def _create_html_response(title, body, feed_url):
             f'<link href="{feed_url}" type="application/atom+xml" rel="alternate" title="{title} feed">\n'  # NOQA
             f'<link href="/main.css" rel="stylesheet">\n'
             f'</head>\n'
-            f'<body>\n'
-            f'{body}\n'
-            f'</body>\n'
-            f'</html>\n')
-    return aiohttp.web.Response(content_type='text/html',
-                                text=text)
+            f'<body>\n')
 
 
-def _generate_repos(repos):
-    items = '\n'.join(f'<li><a href="/repo/{repo}">{repo}</a></li>'
-                      for repo in repos)
+def _generate_repos(repos, status_counts, sync_states):
+    items = '\n'.join(
+        f'<li>'
+        f'{_generate_repo_link(repo)}'
+        f'{_generate_status_counts(status_counts.get(repo, {}))}'
+        f'{_generate_sync_state(sync_states.get(repo))}'
+        f'</li>'
+        for repo in sorted(repos))
     return (f'<div class="repos">\n'
             f'<h2>Repositories</h2>\n'
             f'<ul>\n'
@@ -202,6 +380,63 @@ def _generate_repos(repos):
             f'</div>')
 
 
+def _generate_status_counts(counts):
+    items = ''.join(
+        f'<span class="status-{status.name.lower()}">'
+        f'{status.name}: {counts[status]}'
+        f'</span>'
+        for status in common.Status
+        if counts.get(status))
+    return f'<span class="status-counts">{items}</span>'
+
+
+def _generate_sync_state(state):
+    if not state:
+        return ''
+
+    if state.error:
+        error = html.escape(state.error, quote=True)
+        return (f'<span class="sync-state sync-error" title="{error}">'
+                f'sync failed {_format_time(state.last_sync)}'
+                f'</span>')
+
+    return (f'<span class="sync-state">'
+            f'synced {_format_time(state.last_sync)} '
+            f'({state.duration:.2f}s)'
+            f'</span>')
+
+
+def _generate_queue(queue):
+    if not queue:
+        return ''
+
+    thead = ('<tr>\n'
+             '<th class="col-repo">Repo</th>\n'
+             '<th class="col-hash">Commit</th>\n'
+             '<th class="col-priority">Priority</th>\n'
+             '</tr>')
+
+    tbody = '\n'.join(
+        (f'<tr>\n'
+         f'<td class="col-repo">{_generate_repo_link(item.repo)}</td>\n'
+         f'<td class="col-hash">{_generate_commit_link(item)}</td>\n'
+         f'<td class="col-priority">{item.priority.name}</td>\n'
+         f'</tr>')
+        for item in queue)
+
+    return (f'<div class="queue">\n'
+            f'<h2>Queue</h2>\n'
+            f'<table>\n'
+            f'<thead>\n'
+            f'{thead}\n'
+            f'</thead>\n'
+            f'<tbody>\n'
+            f'{tbody}\n'
+            f'</tbody>\n'
+            f'</table>\n'
+            f'</div>')
+
+
 def _generate_commits(commits):
     thead = ('<tr>\n'
              '<th class="col-change">Change</th>\n'
@@ -245,27 +480,35 @@ def _generate_commit(commit):
                      f'</form>')
 
     repo_link = _generate_repo_link(commit.repo)
+    output_link = (f'<a href="/repo/{commit.repo}/commit/{commit.hash}/'
+                   f'output">Output:</a>')
 
-    return (f'<div class="commit">\n'
+    head = (f'<div class="commit">\n'
             f'<label>Repo:</label><div>{repo_link}</div>\n'
             f'<label>Commit:</label><div>{commit.hash}</div>\n'
             f'<label>Change:</label><div>{_format_time(commit.change)}</div>\n'
             f'<label>Status:</label><div>{commit.status.name}</div>\n'
-            f'<label>Output:</label><pre>{commit.output}</pre>\n'
+            f'<label>{output_link}</label><pre>')
+    tail = (f'</pre>\n'
             f'<label></label><div>{run_button}{remove_button}</div>\n'
             f'</div>')
+    return head, tail
 
 
-def _generate_pagination(page, more_follows):
+def _generate_pagination(previous_cursor, next_cursor):
     content = ''
 
-    if page > 0:
-        content += (f'<a class="previous" href="?page={page - 1}">'
+    if previous_cursor:
+        query = urllib.parse.urlencode(
+            {'before': _encode_cursor(previous_cursor)})
+        content += (f'<a class="previous" href="?{query}">'
                     f'&lt; Previous'
                     f'</a>')
 
-    if more_follows:
-        content += (f'<a class="next" href="?page={page + 1}">'
+    if next_cursor:
+        query = urllib.parse.urlencode(
+            {'after': _encode_cursor(next_cursor)})
+        content += (f'<a class="next" href="?{query}">'
                     f'Next &gt;'
                     f'</a>')
 
@@ -281,8 +524,15 @@ def _generate_run(repo):
             f'</div>')
 
 
-def _generate_clear(repo):
+def _generate_clear(repo, cache_usage):
+    size = (_format_size(cache_usage.size)
+            if cache_usage.size is not None else 'unknown')
+    last_use = (_format_time(cache_usage.last_use)
+                if cache_usage.last_use is not None else 'never')
     return (f'<div class="clear">\n'
+            f'<span class="cache-usage">'
+            f'Cache size: {size}, last used: {last_use}'
+            f'</span>\n'
             f'<form method="post" action="/repo/{repo}/clear">\n'
             f'<input type="submit" value="Clear cache">\n'
             f'</form>\n'
@@ -298,10 +548,43 @@ def _generate_commit_link(commit):
     return f'<a href="{url}">{commit.hash}</a>'
 
 
+def _get_cursor(commit):
+    return common.Cursor(change=commit.change,
+                         repo=commit.repo,
+                         hash=commit.hash)
+
+
+def _encode_cursor(cursor):
+    return ':'.join([str(cursor.change),
+                     urllib.parse.quote(cursor.repo, safe=''),
+                     urllib.parse.quote(cursor.hash, safe='')])
+
+
+def _decode_cursor(cursor_str):
+    with contextlib.suppress(ValueError):
+        change, repo, commit_hash = cursor_str.split(':', 2)
+        return common.Cursor(change=int(change),
+                             repo=urllib.parse.unquote(repo),
+                             hash=urllib.parse.unquote(commit_hash))
+    raise aiohttp.web.HTTPBadRequest()
+
+
 def _format_time(t):
     return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
 
 
+def _format_size(size):
+    if size < 1024:
+        return f'{size} B'
+
+    for unit in ['KiB', 'MiB', 'GiB', 'TiB']:
+        size /= 1024
+        if size < 1024:
+            break
+
+    return f'{size:.1f} {unit}'
+
+
 def format_feed_time(t):
     dt = datetime.datetime.utcfromtimestamp(t)
     return dt.isoformat(timespec='seconds') + 'Z'
@@ -319,8 +602,7 @@ def _generate_feed(server_uuid, title, commits):
         return f'/repo/{commit.repo}/commit/{commit.hash}'
 
     def get_entry_content(commit):
-        return (f'Status: {commit.status.name}\n'
-                f'Output:\n{commit.output}')
+        return f'Status: {commit.status.name}'
 
     feed_updated = max((commit.change for commit in commits),
                        default=int(time.time()))
@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+import typing
+import urllib.parse
+
+from hat import json
+
+from boxhatter import common
+
+
+Headers = typing.Mapping[str, str]
+
+_null_hash = '0' * 40
+
+_event_headers = ['X-GitHub-Event',
+                  'X-Gitea-Event',
+                  'X-Forgejo-Event',
+                  'X-Gogs-Event',
+                  'X-Gitlab-Event']
+
+_push_events = {'push', 'Push Hook', 'Tag Push Hook'}
+
+
+def verify(headers: Headers,
+           body: bytes,
+           secret: str
+           ) -> bool:
+    token = headers.get('X-Gitlab-Token')
+    if token is not None:
+        return hmac.compare_digest(token.encode('utf-8'),
+                                   secret.encode('utf-8'))
+
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256)
+    signature = digest.hexdigest()
+
+    for header in ['X-Hub-Signature-256',
+                   'X-Gitea-Signature',
+                   'X-Forgejo-Signature',
+                   'X-Gogs-Signature']:
+        value = headers.get(header)
+        if value is None:
+            continue
+
+        value = value.strip()
+        if value.startswith('sha256='):
+            value = value[len('sha256='):]
+
+        return hmac.compare_digest(value.lower(), signature)
+
+    return False
+
+
+def parse_push(headers: Headers,
+               body: bytes
+               ) -> typing.Optional[common.Push]:
+    event = next((headers[header] for header in _event_headers
+                  if header in headers), None)
+    if event not in _push_events:
+        return
+
+    try:
+        payload = _decode_payload(headers, body)
+        ref = payload['ref']
+        commit_hash = payload['after']
+
+    except Exception:
+        return
+
+    if not isinstance(ref, str) or not isinstance(commit_hash, str):
+        return
+
+    if not ref.startswith('refs/'):
+        ref = f'refs/heads/{ref}'
+
+    if payload.get('deleted') or commit_hash == _null_hash:
+        commit_hash = None
+
+    return common.Push(ref=ref,
+                       hash=commit_hash)
+
+
+def _decode_payload(headers, body):
+    content_type = headers.get('Content-Type', '')
+    body = str(body, encoding='utf-8')
+
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        body = urllib.parse.parse_qs(body)['payload'][0]
+
+    return json.decode(body)
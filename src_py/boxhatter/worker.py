@@ -0,0 +1,229 @@
+from pathlib import Path
+import asyncio
+import fcntl
+import itertools
+import logging
+import os
+import uuid
+
+from hat import aio
+import aiohttp
+
+from boxhatter import common
+import boxhatter.cache
+import boxhatter.executor
+import boxhatter.image
+import boxhatter.mirror
+
+
+mlog: logging.Logger = logging.getLogger(__name__)
+
+retry_delay: float = 5
+
+output_chunk_size: int = 64 * 1024
+
+mirrors_dir: str = '.mirrors'
+
+caches_dir: str = '.caches'
+
+
+async def create(url: str,
+                 token: str,
+                 name: str,
+                 cache_path: Path,
+                 parallel: int = 1
+                 ) -> 'Worker':
+    worker = Worker()
+    worker._async_group = aio.Group()
+    worker._url = url.rstrip('/')
+    worker._name = name
+    worker._cache_path = cache_path
+    worker._mirrors = {}
+    worker._session = aiohttp.ClientSession(
+        headers={'Authorization': f'Bearer {token}'})
+    worker.async_group.spawn(aio.call_on_cancel, worker._session.close)
+
+    try:
+        cache_lock, worker_cache_path = _lock_cache(cache_path / caches_dir /
+                                                    name)
+        worker.async_group.spawn(aio.call_on_cancel, os.close, cache_lock)
+
+        worker._cache_manager = await boxhatter.cache.create(
+            path=worker_cache_path,
+            repos=[])
+        worker.async_group.spawn(aio.call_on_cancel,
+                                 worker._cache_manager.async_close)
+        worker.async_group.spawn(aio.call_on_done,
+                                 worker._cache_manager.wait_closing(),
+                                 worker.close)
+
+        worker._image_manager = await boxhatter.image.create()
+        worker.async_group.spawn(aio.call_on_cancel,
+                                 worker._image_manager.async_close)
+        worker.async_group.spawn(aio.call_on_done,
+                                 worker._image_manager.wait_closing(),
+                                 worker.close)
+
+    except BaseException:
+        await aio.uncancellable(worker.async_close())
+        raise
+
+    for _ in range(parallel):
+        worker.async_group.spawn(worker._worker_loop)
+
+    return worker
+
+
+class Worker(aio.Resource):
+
+    @property
+    def async_group(self) -> aio.Group:
+        return self._async_group
+
+    async def _worker_loop(self):
+        try:
+            while True:
+                try:
+                    job = await self._lease()
+
+                except Exception as e:
+                    mlog.warning('lease request failed: %s', e)
+                    await asyncio.sleep(retry_delay)
+                    continue
+
+                if job:
+                    await self._run(job)
+
+        finally:
+            self.close()
+
+    async def _lease(self):
+        async with self._session.post(f'{self._url}/worker/lease',
+                                      json={'worker': self._name}) as res:
+            if res.status == 204:
+                return
+
+            res.raise_for_status()
+            data = await res.json()
+
+        return common.Job(**data)
+
+    async def _run(self, job):
+        lease_url = f'{self._url}/worker/lease/{job.lease}'
+        output = _Output(self._session, f'{lease_url}/output')
+
+        run_group = self.async_group.create_subgroup()
+
+        try:
+            task = run_group.spawn(self._execute, job, output)
+            run_group.spawn(self._heartbeat_loop, lease_url,
+                            job.lease_timeout, run_group)
+
+            await asyncio.wait([task])
+
+        finally:
+            await aio.uncancellable(run_group.async_close())
+
+        if task.cancelled():
+            mlog.warning('lease %s lost', job.lease)
+            return
+
+        try:
+            await output.flush()
+            async with self._session.post(f'{lease_url}/finish',
+                                          json={'error': task.result()}
+                                          ) as res:
+                res.raise_for_status()
+
+        except Exception as e:
+            mlog.warning('finishing lease %s failed: %s', job.lease, e)
+
+    async def _execute(self, job, output):
+        mirror = self._mirrors.get(job.repo)
+        if not mirror:
+            mirror = boxhatter.mirror.Mirror(
+                self._cache_path / mirrors_dir / job.repo, job.url)
+            self._mirrors[job.repo] = mirror
+
+        cache_src = None
+
+        try:
+            await self._cache_manager.add_repo(job.repo)
+            cache_src = await self._cache_manager.create_snapshot(job.repo)
+
+            await boxhatter.executor.execute(
+                action=job.action,
+                env=job.env,
+                cache_src=cache_src,
+                cache_dst=job.cache_dst,
+                url=job.url,
+                ref=job.hash,
+                container_name=f'boxhatter-{uuid.uuid4()}',
+                output=output,
+                mirror=mirror,
+                image_manager=self._image_manager,
+                timeout=job.timeout)
+
+            await self._cache_manager.promote(job.repo, cache_src)
+            cache_src = None
+
+        except Exception as e:
+            return str(e)
+
+        finally:
+            if cache_src:
+                await aio.uncancellable(
+                    self._cache_manager.remove(job.repo, cache_src))
+
+    async def _heartbeat_loop(self, lease_url, lease_timeout, run_group):
+        while True:
+            await asyncio.sleep(lease_timeout / 3)
+
+            try:
+                async with self._session.post(f'{lease_url}/heartbeat') as res:
+                    if res.status == 404:
+                        run_group.close()
+                        return
+
+                    res.raise_for_status()
+
+            except Exception as e:
+                mlog.warning('heartbeat failed: %s', e)
+
+
+class _Output(boxhatter.executor.Output):
+
+    def __init__(self, session, url):
+        self._session = session
+        self._url = url
+        self._data = bytearray()
+
+    async def write(self, data):
+        self._data.extend(data)
+        if len(self._data) >= output_chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._data:
+            return
+
+        data, self._data = bytes(self._data), bytearray()
+        async with self._session.post(self._url, data=data) as res:
+            if res.status == 404:
+                raise Exception('lease lost')
+
+            res.raise_for_status()
+
+
+def _lock_cache(path):
+    path.mkdir(parents=True, exist_ok=True)
+
+    for i in itertools.count():
+        fd = os.open(path / f'{i}.lock', os.O_RDWR | os.O_CREAT)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd, path / str(i)
+
+        except BlockingIOError:
+            os.close(fd)